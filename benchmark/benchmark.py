@@ -0,0 +1,485 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+GAME_FOLDER = 'Wuthering Waves Game'
+OLD_VERSION = '1.0.0'
+NEW_VERSION = '1.1.0'
+GENERATE_CHUNK_SIZE = 1024 * 1024
+SCENARIOS = ('install', 'verify', 'deep-verify', 'update', 'patch-update')
+
+def parse_size(text):
+    text = text.strip().upper().removesuffix('B')
+    multiplier = 1
+    if text and text[-1] in 'KMG':
+        multiplier = 1024 ** ('KMG'.index(text[-1]) + 1)
+        text = text[:-1]
+    return int(float(text) * multiplier)
+
+def parse_distribution(text):
+    # "64K:70,4M:25,128M:5" is 70% files around 64K, 25% around 4M and 5% around 128M
+    distribution = []
+    for item in text.split(','):
+        size, _, weight = item.partition(':')
+        distribution.append((parse_size(size), float(weight or 1)))
+    return distribution
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024 or unit == 'GB':
+            return f'{size:.0f}{unit}' if unit == 'B' else f'{size:.1f}{unit}'
+        size /= 1024
+
+def write_random_file(file_path, size, rnd):
+    # random bytes, so neither the server nor the filesystem gets away with compressing them
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    md5_hash = hashlib.md5()
+    with open(file_path, 'wb') as file:
+        remaining = size
+        while remaining:
+            chunk = rnd.randbytes(min(GENERATE_CHUNK_SIZE, remaining))
+            md5_hash.update(chunk)
+            file.write(chunk)
+            remaining -= len(chunk)
+    return {'dest': None, 'md5': md5_hash.hexdigest(), 'size': size}
+
+def save_json(file_path, data):
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(file_path, 'w', encoding='utf-8') as file:
+        json.dump(data, file)
+
+class Dataset:
+
+    def __init__(self, cdn_path, file_count, distribution, update_ratio, seed):
+        self.cdn_path = cdn_path
+        self.file_count = file_count
+        self.distribution = distribution
+        self.update_ratio = update_ratio
+        self.rnd = random.Random(seed)
+        self.manifests = {}
+        self.patch_config = []
+
+    def resource_path(self, version, dest):
+        return self.cdn_path / 'res' / version / dest
+
+    def random_size(self):
+        sizes, weights = zip(*self.distribution)
+        size = self.rnd.choices(sizes, weights)[0]
+        return max(1, int(size * self.rnd.uniform(0.5, 1.5)))
+
+    def add_file(self, version, dest, size):
+        entry = write_random_file(self.resource_path(version, dest), size, self.rnd)
+        entry['dest'] = dest
+        return entry
+
+    def build(self):
+        old_resources = []
+        for i in range(self.file_count):
+            dest = f'Client/Content/Paks/pakchunk{i}-WindowsNoEditor.pak' if i % 4 else f'Client/Binaries/Win64/file{i}.bin'
+            old_resources.append(self.add_file(OLD_VERSION, dest, self.random_size()))
+        self.manifests[OLD_VERSION] = old_resources
+
+        # the new version rewrites some files in place, drops one and adds one; the rest are hardlinks
+        changed = set(self.rnd.sample(range(len(old_resources)), max(1, int(len(old_resources) * self.update_ratio))))
+        removed = self.rnd.choice([i for i in range(len(old_resources)) if i not in changed]) if len(old_resources) > len(changed) else None
+        new_resources = []
+        for i, entry in enumerate(old_resources):
+            if i == removed:
+                continue
+            if i in changed:
+                new_resources.append(self.add_file(NEW_VERSION, entry['dest'], entry['size']))
+            else:
+                new_path = self.resource_path(NEW_VERSION, entry['dest'])
+                new_path.parent.mkdir(parents=True, exist_ok=True)
+                os.link(self.resource_path(OLD_VERSION, entry['dest']), new_path)
+                new_resources.append(entry)
+        new_resources.append(self.add_file(NEW_VERSION, 'Client/Content/Paks/pakchunk-new-WindowsNoEditor.pak', self.random_size()))
+        self.manifests[NEW_VERSION] = new_resources
+        self.changed_dests = [old_resources[i]['dest'] for i in sorted(changed)]
+
+        for version, resources in self.manifests.items():
+            save_json(self.cdn_path / 'res' / version / 'manifest.json', {'resource': resources})
+
+    def build_patch(self, hdiffz):
+        # the diff only covers the changed files, hpatchz reads their old versions from the game folder
+        patch_name = f'{OLD_VERSION}-{NEW_VERSION}'
+        patch_path = self.cdn_path / 'patch' / patch_name
+        stage_path = self.cdn_path.parent / 'patch-stage'
+        for version in (OLD_VERSION, NEW_VERSION):
+            for dest in self.changed_dests:
+                stage_file_path = stage_path / version / dest
+                stage_file_path.parent.mkdir(parents=True, exist_ok=True)
+                os.link(self.resource_path(version, dest), stage_file_path)
+        patch_path.mkdir(parents=True, exist_ok=True)
+        diff_path = patch_path / 'game.krdiff'
+        subprocess.run([hdiffz, '-f', str(stage_path / OLD_VERSION), str(stage_path / NEW_VERSION), str(diff_path)],
+                       check=True, stdout=subprocess.DEVNULL)
+        shutil.rmtree(stage_path)
+
+        md5_hash = hashlib.md5()
+        with open(diff_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(GENERATE_CHUNK_SIZE), b''):
+                md5_hash.update(chunk)
+        old_dests = {entry['dest'] for entry in self.manifests[OLD_VERSION]}
+        resources = [{'dest': 'game.krdiff', 'md5': md5_hash.hexdigest(), 'size': diff_path.stat().st_size}]
+        resources += [dict(entry, fromFolder=f'res/{NEW_VERSION}')
+                      for entry in self.manifests[NEW_VERSION] if entry['dest'] not in old_dests]
+        save_json(patch_path / 'index.json', {'resource': resources})
+        self.patch_config = [{
+            'version': OLD_VERSION,
+            'baseUrl': f'patch/{patch_name}',
+            'indexFile': f'patch/{patch_name}/index.json',
+            # only checked for being non-empty by the launcher
+            'ext': {'krdiff': 'game.krdiff'},
+        }]
+
+    def size(self, version):
+        return sum(entry['size'] for entry in self.manifests[version])
+
+class FakeCdnHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = unquote(urlsplit(self.path).path).lstrip('/')
+        if path in ('index.json', 'background.json'):
+            # the launcher api, an empty background config keeps the launcher from fetching images
+            body = json.dumps(self.server.launcher_info() if path == 'index.json' else {}).encode('utf-8')
+            self.send_head(200, len(body), {'Content-Type': 'application/json'})
+            self.wfile.write(body)
+            self.server.count(len(body), request=True)
+            return
+        file_path = (self.server.cdn_path / path).resolve()
+        if self.server.cdn_path not in file_path.parents or not file_path.is_file():
+            self.send_head(404, 0)
+            return
+        with open(file_path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            etag = f'"{os.fstat(file.fileno()).st_ino:x}-{size:x}"'
+            start, end, status = 0, size - 1, 200
+            range_header = self.headers.get('Range')
+            if range_header and range_header.startswith('bytes=') and self.headers.get('If-Range', etag) == etag:
+                first, _, last = range_header[6:].partition('-')
+                start = int(first) if first else max(size - int(last), 0)
+                end = min(int(last), size - 1) if first and last else size - 1
+                if start > end:
+                    self.send_head(416, 0, {'Content-Range': f'bytes */{size}'})
+                    return
+                status = 206
+            headers = {'ETag': etag, 'Accept-Ranges': 'bytes'}
+            if status == 206:
+                headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+            self.send_head(status, end - start + 1, headers)
+            self.send_body(file, start, end - start + 1)
+
+    def send_head(self, status, length, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Length', str(length))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def send_body(self, file, offset, length):
+        rate = self.server.rate
+        self.server.count(0, request=True)
+        if not rate:
+            self.connection.sendfile(file, offset, length)
+            self.server.count(length)
+            return
+        # every connection is held to rate, like a cdn node serving many users
+        file.seek(offset)
+        start_time = time.monotonic()
+        sent = 0
+        while sent < length:
+            chunk = file.read(min(64 * 1024, length - sent))
+            self.wfile.write(chunk)
+            sent += len(chunk)
+            self.server.count(len(chunk))
+            delay = sent / rate - (time.monotonic() - start_time)
+            if delay > 0:
+                time.sleep(delay)
+
+class FakeCdnServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, cdn_path, rate=0):
+        super().__init__(('127.0.0.1', 0), FakeCdnHandler)
+        self.cdn_path = cdn_path.resolve()
+        self.rate = rate
+        self.version = OLD_VERSION
+        self.patch_config = []
+        self.lock = threading.Lock()
+        self.bytes_sent = 0
+        self.requests = 0
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/'
+
+    def launcher_info(self):
+        port = self.server_address[1]
+        return {'default': {
+            'version': self.version,
+            'resourcesBasePath': f'res/{self.version}',
+            # two names for the same server, so node selection and striping have something to do
+            'cdnList': [
+                {'url': f'http://127.0.0.1:{port}/', 'K1': 1, 'K2': 1, 'P': 100},
+                {'url': f'http://localhost:{port}/', 'K1': 1, 'K2': 1, 'P': 50},
+            ],
+            'config': {
+                'indexFile': f'res/{self.version}/manifest.json',
+                'patchConfig': self.patch_config if self.version == NEW_VERSION else [],
+            },
+        }}
+
+    def count(self, size, request=False):
+        with self.lock:
+            self.bytes_sent += size
+            self.requests += request
+
+    def counters(self):
+        with self.lock:
+            return self.bytes_sent, self.requests
+
+def read_io_counters():
+    # bytes that reached the storage layer, page cache hits are not counted
+    try:
+        with open('/proc/self/io', 'r') as file:
+            counters = dict(line.split(': ') for line in file.read().splitlines())
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+    except OSError:
+        if resource is None:
+            return None, None
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_inblock * 512, usage.ru_oublock * 512
+
+def peak_rss():
+    if resource is None:
+        return None
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def run_worker(args):
+    # runs one scenario in a fresh process, the launcher is a singleton and keeps its state next to sys.argv[0]
+    work_path = Path(args.work)
+    work_path.mkdir(parents=True, exist_ok=True)
+    os.chdir(work_path)
+    sys.argv = [str(work_path / 'LutheringLaves.py')]
+    sys.path.insert(0, str(REPO_DIR))
+    import src.LutheringLaves as LutheringLaves
+    LutheringLaves.WW_LAUNCHER_API = args.api + 'index.json'
+    LutheringLaves.WW_LAUNCHER_DOWNLOAD_API = args.api + 'background.json'
+    LutheringLaves.set_log_levels({'all': args.log_level})
+
+    hpatchz = REPO_DIR / 'tools' / ('hpatchz.exe' if os.name == 'nt' else 'hpatchz')
+    if args.scenario == 'patch-update' and hpatchz.exists():
+        tool_path = work_path / 'tools' / hpatchz.name
+        tool_path.parent.mkdir(exist_ok=True)
+        shutil.copy(hpatchz, tool_path)
+
+    start_time = time.perf_counter()
+    launcher = LutheringLaves.Launcher(game_folder=GAME_FOLDER)
+    init_time = time.perf_counter() - start_time
+    for name, value in json.loads(args.settings).items():
+        setattr(launcher, name, value)
+
+    read_before, write_before = read_io_counters()
+    start_time = time.perf_counter()
+    if args.scenario == 'install':
+        failed_files = launcher.download_game() or launcher.verify_gamefile()
+    elif args.scenario == 'verify':
+        failed_files = launcher.verify_gamefile()
+    elif args.scenario == 'deep-verify':
+        launcher.deep_verify = True
+        failed_files = launcher.verify_gamefile()
+    elif args.scenario == 'update':
+        failed_files = launcher.update_game()
+    elif args.scenario == 'patch-update':
+        failed_files = launcher.download_patch()
+        if failed_files is not None and not failed_files:
+            failed_files = launcher.merge_patch()
+    wall_time = time.perf_counter() - start_time
+    read_after, write_after = read_io_counters()
+
+    result = {
+        'init_time': init_time,
+        'wall_time': wall_time,
+        'peak_rss': peak_rss(),
+        'read_bytes': None if read_before is None else read_after - read_before,
+        'write_bytes': None if write_before is None else write_after - write_before,
+        'failed_files': None if failed_files is None else list(failed_files),
+    }
+    with open(args.result, 'w', encoding='utf-8') as file:
+        json.dump(result, file)
+
+def run_scenario(server, scenario, work_path, game_size, args):
+    result_path = work_path.parent / f'{scenario}.result.json'
+    settings = {}
+    if args.jobs:
+        settings['download_jobs'] = args.jobs
+    if args.segments:
+        settings['download_segments'] = args.segments
+    if args.hash_jobs:
+        settings['hash_jobs'] = args.hash_jobs
+    command = [sys.executable, str(Path(__file__).resolve()), '--worker', scenario, '--api', server.url,
+               '--work', str(work_path), '--result', str(result_path), '--settings', json.dumps(settings),
+               '--log-level', args.log_level]
+    bytes_before, requests_before = server.counters()
+    process = subprocess.run(command)
+    bytes_after, requests_after = server.counters()
+    if process.returncode != 0 or not result_path.exists():
+        return {'scenario': scenario, 'error': f'worker exited with {process.returncode}'}
+    with open(result_path, 'r', encoding='utf-8') as file:
+        result = json.load(file)
+    wall_time = max(result['wall_time'], 1e-9)
+    return {
+        'scenario': scenario,
+        'game_size': game_size,
+        'bytes_served': bytes_after - bytes_before,
+        'requests': requests_after - requests_before,
+        # network bytes per second, and game data handled per second (what verify is judged by)
+        'network_throughput': (bytes_after - bytes_before) / wall_time,
+        'data_throughput': game_size / wall_time,
+        **result,
+    }
+
+def print_summary(results):
+    print(f"{'scenario':<14}{'wall':>9}{'network':>12}{'data':>12}{'peak rss':>11}{'read':>11}{'written':>11}  failed")
+    for result in results:
+        if 'error' in result or 'skipped' in result:
+            print(f"{result['scenario']:<14}  {result.get('error') or result['skipped']}")
+            continue
+        failed = result['failed_files']
+        print(f"{result['scenario']:<14}{result['wall_time']:>8.2f}s"
+              f"{format_size(result['network_throughput']) + '/s':>12}{format_size(result['data_throughput']) + '/s':>12}"
+              f"{format_size(result['peak_rss'] or 0):>11}{format_size(result['read_bytes'] or 0):>11}"
+              f"{format_size(result['write_bytes'] or 0):>11}  {'-' if failed is None else len(failed)}")
+
+def main():
+    parser = argparse.ArgumentParser(description='install, update, verify and patch-update against a local fake cdn')
+    parser.add_argument('--files', type=int, default=100, help='number of game files')
+    parser.add_argument('--sizes', type=parse_distribution, default='64K:70,4M:25,96M:5', metavar='SIZE:WEIGHT,...',
+                        help='file size distribution, every size varies by +-50%%')
+    parser.add_argument('--update-ratio', type=float, default=0.1, help='fraction of files changed by the update')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f'comma separated subset of {", ".join(SCENARIOS)}')
+    parser.add_argument('--rate', type=parse_size, default=0, metavar='RATE', help='bytes per second of every connection, 0 for unlimited')
+    parser.add_argument('--jobs', type=int, default=None, help='download_jobs of the launcher')
+    parser.add_argument('--segments', type=int, default=None, help='download_segments of the launcher')
+    parser.add_argument('--hash-jobs', type=int, default=None, help='hash_jobs of the launcher')
+    parser.add_argument('--hdiffz', default=shutil.which('hdiffz'), help='hdiffz used to build the patch-update diff')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workdir', default=None, help='kept after the run, a temporary folder otherwise')
+    parser.add_argument('--output', default='benchmark-results.json', help='json file the results are written to')
+    parser.add_argument('--log-level', default='WARNING', help='log level of the launcher')
+    parser.add_argument('--worker', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--api', help=argparse.SUPPRESS)
+    parser.add_argument('--work', help=argparse.SUPPRESS)
+    parser.add_argument('--result', help=argparse.SUPPRESS)
+    parser.add_argument('--settings', default='{}', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        args.scenario = args.worker
+        run_worker(args)
+        return
+
+    scenarios = [scenario.strip() for scenario in args.scenarios.split(',') if scenario.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+
+    root_path = Path(args.workdir or tempfile.mkdtemp(prefix='lutheringlaves-benchmark-')).resolve()
+    root_path.mkdir(parents=True, exist_ok=True)
+    print(f'Building {args.files} files in {root_path}', flush=True)
+    dataset = Dataset(root_path / 'cdn', args.files, args.sizes, args.update_ratio, args.seed)
+    dataset.build()
+    patch_error = None
+    if 'patch-update' in scenarios:
+        if not args.hdiffz:
+            patch_error = 'hdiffz not found, pass --hdiffz'
+        else:
+            try:
+                dataset.build_patch(args.hdiffz)
+            except (OSError, subprocess.CalledProcessError) as e:
+                patch_error = f'building the patch failed: {e}'
+
+    server = FakeCdnServer(root_path / 'cdn', args.rate)
+    server.patch_config = dataset.patch_config
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # install and the verifies share one folder; update and patch-update each start from a copy of it
+    installed_path = root_path / 'install'
+    results = []
+    try:
+        for scenario in scenarios:
+            if scenario == 'patch-update' and patch_error:
+                results.append({'scenario': scenario, 'skipped': patch_error})
+                continue
+            if scenario in ('update', 'patch-update'):
+                if not installed_path.exists():
+                    results.append({'scenario': scenario, 'skipped': 'needs the install scenario'})
+                    continue
+                work_path = root_path / scenario
+                shutil.rmtree(work_path, ignore_errors=True)
+                shutil.copytree(installed_path, work_path)
+                server.version = NEW_VERSION
+            else:
+                work_path = installed_path
+                server.version = OLD_VERSION
+            if scenario != 'install' and not work_path.exists():
+                results.append({'scenario': scenario, 'skipped': 'needs the install scenario'})
+                continue
+            print(f'Running {scenario}', flush=True)
+            results.append(run_scenario(server, scenario, work_path, dataset.size(server.version), args))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'config': {
+            'files': args.files,
+            'sizes': args.sizes,
+            'update_ratio': args.update_ratio,
+            'rate': args.rate,
+            'jobs': args.jobs,
+            'segments': args.segments,
+            'hash_jobs': args.hash_jobs,
+            'seed': args.seed,
+            'game_size': dataset.size(OLD_VERSION),
+        },
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=4)
+    print_summary(results)
+    print(f'Results written to {args.output}')
+    if not args.workdir:
+        shutil.rmtree(root_path, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
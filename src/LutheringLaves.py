@@ -1,28 +1,85 @@
 
 import os
 import shutil
+import errno
 import hashlib
+import zlib
 import json
 import gzip
 import io
 import argparse
 import logging
+import atexit
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import subprocess
+import threading
+import time
+import random
+import re
+import math
+import bisect
+import functools
+import cProfile
+import pstats
+import tracemalloc
+import socket
+import socketserver
+import ssl
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from enum import Enum
+from typing import NamedTuple
 from pathlib import Path
-from urllib.request import urlopen, Request, HTTPError
-from urllib.parse import urljoin,quote
-
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[logging.FileHandler('launcher.log', encoding='utf-8'), logging.StreamHandler()]
-)
+from urllib.request import getproxies, proxy_bypass
+from urllib.parse import urljoin,quote,unquote,urlsplit
+
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+
+# records are only queued by the calling thread, a listener thread does the file and console writes
+log_queue = queue.SimpleQueue()
+log_formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
+log_file_handler = RotatingFileHandler('launcher.log', maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+log_file_handler.setFormatter(log_formatter)
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(log_formatter)
+log_listener = QueueListener(log_queue, log_file_handler, log_stream_handler)
+log_listener.start()
+atexit.register(log_listener.stop)
+logging.basicConfig(level=logging.INFO, format='%(message)s', handlers=[QueueHandler(log_queue)])
 logger = logging.getLogger("LutheringLaves")
+# per-phase loggers, their levels come from the log_levels setting or --log-level
+download_logger = logger.getChild('download')
+verify_logger = logger.getChild('verify')
+cdn_logger = logger.getChild('cdn')
+patch_logger = logger.getChild('patch')
+mirror_logger = logger.getChild('mirror')
+LOG_PHASES = ('download', 'verify', 'cdn', 'patch', 'mirror')
+
+def set_log_levels(log_levels):
+    # {"download": "DEBUG"}; the key "all" sets the launcher logger itself
+    for phase, level in log_levels.items():
+        target = logger if phase == 'all' else logger.getChild(phase)
+        try:
+            target.setLevel(level.upper() if isinstance(level, str) else level)
+        except (ValueError, TypeError):
+            logger.warning(f"Ignoring invalid log level {level!r} for {phase}")
 
 # 适配 nuitka 打包后证书丢失与文件路径异常问题
 import certifi
 os.environ["SSL_CERT_FILE"] = certifi.where()
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 import sys
 base_dir = os.path.dirname(sys.argv[0])
 logger.info(f"base dir: {base_dir}")
@@ -30,6 +87,84 @@ logger.info(f"base dir: {base_dir}")
 WW_LAUNCHER_DOWNLOAD_API = 'https://prod-cn-alicdn-gamestarter.kurogame.com/launcher/launcher/10003_Y8xXrXk65DqFHEDgApn3cpK5lfczpFx5/G152/index.json'
 WW_LAUNCHER_API = 'https://prod-cn-alicdn-gamestarter.kurogame.com/launcher/game/G152/10003_Y8xXrXk65DqFHEDgApn3cpK5lfczpFx5/index.json'
 
+DEFAULT_DOWNLOAD_JOBS = 4
+DEFAULT_DOWNLOAD_SEGMENTS = 4
+DEFAULT_HASH_JOBS = min(4, os.cpu_count() or 1)
+HASH_BUFFER_SIZE = 1024 * 1024
+DEFAULT_HTTP_POOL_SIZE = 16
+DNS_CACHE_TTL = 300
+MAX_REDIRECTS = 5
+# reads of a rate limited response are split into pieces of this size, so connections take turns
+BANDWIDTH_QUANTUM = 64 * 1024
+# seconds of traffic that may be sent at once after the line was idle
+BANDWIDTH_BURST = 0.25
+MANIFEST_CACHE_ZSTD_LEVEL = 10
+# characters of manifest text decoded at a time, only the current chunk and one entry are held as text
+MANIFEST_PARSE_CHUNK_SIZE = 64 * 1024
+# bytes requested from every cdn node when measuring it at startup
+CDN_PROBE_SIZE = 256 * 1024
+CDN_PROBE_TIMEOUT = 5
+CDN_STATS_HALF_LIFE = 7 * 24 * 3600
+# files are spread over at most this many of the fastest nodes
+CDN_STRIPE_NODES = 3
+# nodes slower than this fraction of the fastest one are not used for striping
+CDN_STRIPE_MIN_RATIO = 0.3
+# retries of a failed download, each resumes from the bytes already on disk
+DOWNLOAD_RETRIES = 5
+RETRY_BACKOFF_BASE = 1
+RETRY_BACKOFF_MAX = 30
+# consecutive failures that take a cdn node out of rotation for CIRCUIT_COOLDOWN seconds
+CIRCUIT_FAILURE_THRESHOLD = 3
+CIRCUIT_COOLDOWN = 60
+# immediate re-downloads of a file whose md5 does not match the manifest
+MD5_MISMATCH_RETRIES = 2
+# files at least this large are fetched as several concurrent byte ranges
+SEGMENTED_DOWNLOAD_MIN_SIZE = 64 * 1024 * 1024
+# files at least this large are preallocated, their progress is kept in .temp.segments
+PREALLOCATE_MIN_SIZE = 8 * 1024 * 1024
+# buffers shared by the network threads and the writer thread of one file
+WRITE_BUFFER_SIZE = 1024 * 1024
+WRITE_BUFFER_COUNT = 8
+# resume state of a preallocated file is saved after this many written bytes
+SEGMENT_STATE_INTERVAL = 16 * 1024 * 1024
+# partial files are checksummed in blocks of this size, a damaged block is all that is fetched again
+JOURNAL_BLOCK_SIZE = 4 * 1024 * 1024
+# hpatchz announces the size of the whole directory it is about to write, unchanged files included
+HPATCHZ_NEW_SIZE_PATTERN = re.compile(r'newSumSize\s*:\s*(\d+)')
+# lines of hpatchz output kept for the error report of a failed run
+HPATCHZ_OUTPUT_TAIL = 20
+# hpatchz -info only reads the header of a diff
+HPATCHZ_INFO_TIMEOUT = 60
+# free space left untouched on top of what a job needs
+DISK_SPACE_RESERVE = 256 * 1024 * 1024
+# largest piece handed to a single copy_file_range call
+COPY_CHUNK_SIZE = 1024 * 1024 * 1024
+# ioctl that makes a file share the extents of another on btrfs and xfs
+FICLONE = 0x40049409
+# a mirror describes itself here, clients only use it when version and resourcesBasePath match
+MIRROR_INFO_PATH = 'launcherMirror.json'
+# diffs of a patch already moved into the game folder, with the files each one wrote, kept in the patch folder
+PATCH_APPLIED_PATH = 'applied.json'
+DEFAULT_MIRROR_PORT = 8080
+# the control api of --daemon only listens on loopback unless told otherwise
+DEFAULT_DAEMON_ADDRESS = '127.0.0.1:8081'
+# idle event streams get a ping this often, so clients notice a dead daemon
+DAEMON_EVENT_PING_INTERVAL = 15
+# events queued for one stream before the oldest are dropped, a client that stops reading costs no more
+DAEMON_EVENT_QUEUE_SIZE = 256
+# upper bounds of the histogram buckets, in seconds and in bytes
+METRICS_SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800)
+METRICS_BYTES_BUCKETS = (64 * 1024, 1024 * 1024, 16 * 1024 * 1024, 64 * 1024 * 1024, 256 * 1024 * 1024, 1024 * 1024 * 1024)
+METRICS_PREFIX = 'lutheringlaves'
+# lines of the cProfile and tracemalloc reports written by --profile
+PROFILE_REPORT_LINES = 40
+# progress snapshots are published at most this often, in seconds
+PROGRESS_INTERVAL = 0.1
+# an unfinished progress that did not move is still published this often, so a stall shows up as falling speed
+PROGRESS_IDLE_INTERVAL = 1
+# time constant of the moving average behind the reported speed and ETA
+PROGRESS_SPEED_WINDOW = 5
+
 class LauncherState(Enum):
     STARTGAME = 0
     GAMERUNNING =1
@@ -44,10 +179,1739 @@ class LauncherState(Enum):
 class ProgressInfo:
     def __init__(self):
         self.total_size = 0
-        self.finished_size = 0
         self.total_count = 0
-        self.finished_count = 0
+        # every thread adds to its own [size, count] cell, readers sum the cells
+        self.cells = []
+        self.local = threading.local()
+        # cells of threads that have exited are folded in here, pools come and go for the life of the process
+        self.folded_size = 0
+        self.folded_count = 0
+        self.base_size = 0
+        self.base_count = 0
+        # bumped by reset so readers can tell a new run from a rollback
+        self.generation = 0
+        self.lock = threading.RLock()
+    
+    def reset(self, total_size=0, total_count=0):
+        with self.lock:
+            self.total_size = total_size
+            self.total_count = total_count
+            self.base_size, self.base_count = self.sum_cells()
+            self.generation += 1
+    
+    def advance(self, size=0, count=0):
+        cell = getattr(self.local, 'cell', None)
+        if cell is None:
+            cell = self.local.cell = [0, 0]
+            with self.lock:
+                self.cells.append((threading.current_thread(), cell))
+        cell[0] += size
+        cell[1] += count
+    
+    def sum_cells(self):
+        with self.lock:
+            live_cells = []
+            for thread, cell in self.cells:
+                if thread.is_alive():
+                    live_cells.append((thread, cell))
+                else:
+                    # an exited thread no longer writes to its cell
+                    self.folded_size += cell[0]
+                    self.folded_count += cell[1]
+            self.cells = live_cells
+            folded_size, folded_count = self.folded_size, self.folded_count
+        return (folded_size + sum(cell[0] for _, cell in live_cells),
+                folded_count + sum(cell[1] for _, cell in live_cells))
+    
+    @property
+    def finished_size(self):
+        return self.sum_cells()[0] - self.base_size
+    
+    @property
+    def finished_count(self):
+        return self.sum_cells()[1] - self.base_count
+
+class ProgressSnapshot(NamedTuple):
+    flag: str
+    total_size: int
+    finished_size: int
+    total_count: int
+    finished_count: int
+    # bytes per second, moving average over PROGRESS_SPEED_WINDOW
+    speed: float
+    # seconds left at the current speed, None while the speed is unknown
+    eta: float
+    paused: bool
+
+class ProgressReporter:
+    
+    def __init__(self, progress_map, callback, is_paused=lambda: False, interval=PROGRESS_INTERVAL):
+        self.progress_map = progress_map
+        self.callback = callback
+        self.is_paused = is_paused
+        self.interval = interval
+        # flag -> (generation, finished_size, sample time, weighted average, weight, time of the last progress)
+        self.samples = {}
+        # flag -> (state, publish time)
+        self.last_published = {}
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='ProgressReporter', daemon=True)
+    
+    def start(self):
+        self.thread.start()
+    
+    def stop(self):
+        self.stop_event.set()
+        if self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.publish()
+    
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.publish()
+            except Exception as e:
+                logger.error(f'Progress callback failed: {e}')
+    
+    def publish(self):
+        now = time.monotonic()
+        paused = self.is_paused()
+        for flag, progress in self.progress_map.items():
+            generation = progress.generation
+            finished_size, finished_count = progress.sum_cells()
+            finished_size -= progress.base_size
+            finished_count -= progress.base_count
+            speed = self.sample_speed(flag, generation, finished_size, now, paused)
+            
+            state = (generation, progress.total_size, finished_size, progress.total_count, finished_count, paused)
+            last_state, last_time = self.last_published.get(flag, (None, 0))
+            if last_state == state:
+                # a stalled run is published now and then with its decaying speed, a finished or paused one is not
+                finished = finished_size >= progress.total_size and finished_count >= progress.total_count
+                if finished or paused or now - last_time < PROGRESS_IDLE_INTERVAL:
+                    continue
+            self.last_published[flag] = (state, now)
+            if generation == 0:
+                # nothing was started with this progress yet
+                continue
+            
+            remaining = max(0, progress.total_size - finished_size)
+            eta = remaining / speed if speed > 0 else None
+            self.callback(ProgressSnapshot(
+                flag=flag,
+                total_size=progress.total_size,
+                finished_size=finished_size,
+                total_count=progress.total_count,
+                finished_count=finished_count,
+                speed=speed,
+                eta=eta,
+                paused=paused,
+            ))
+    
+    def sample_speed(self, flag, generation, finished_size, now, paused):
+        sample = self.samples.get(flag)
+        if sample is None or sample[0] != generation:
+            self.samples[flag] = (generation, finished_size, now, 0.0, 0.0, now)
+            return 0.0
+        _, last_size, last_time, average, weight, last_active = sample
+        elapsed = now - last_time
+        if paused or elapsed <= 0:
+            # time spent paused is left out of the average and does not count as a stall
+            self.samples[flag] = (generation, finished_size, now, average, weight, now if paused else last_active)
+            return 0.0 if paused or not weight else average / weight
+        if finished_size > last_size:
+            last_active = now
+        elif now - last_active >= PROGRESS_SPEED_WINDOW:
+            # nothing arrived for a whole window, what is left of the average is history
+            self.samples[flag] = (generation, finished_size, now, 0.0, weight, last_active)
+            return 0.0
+        # exponential moving average, independent of how often we sample;
+        # dividing by the accumulated weight removes the bias towards zero at the start
+        alpha = 1 - math.exp(-elapsed / PROGRESS_SPEED_WINDOW)
+        current = max(0, finished_size - last_size) / elapsed
+        average += alpha * (current - average)
+        weight += alpha * (1 - weight)
+        self.samples[flag] = (generation, finished_size, now, average, weight, last_active)
+        return average / weight
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if abs(size) < 1024 or unit == 'GB':
+            return f'{size:.1f}{unit}' if unit != 'B' else f'{size:.0f}B'
+        size /= 1024
+
+def format_eta(eta):
+    if eta is None:
+        return '--:--'
+    minutes, seconds = divmod(int(eta), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}:{minutes:02d}:{seconds:02d}' if hours else f'{minutes:02d}:{seconds:02d}'
+
+def open_compressed(file_path):
+    if zstandard:
+        return zstandard.ZstdDecompressor().stream_reader(open(file_path, 'rb'), closefd=True)
+    return gzip.open(file_path, 'rb')
+
+def compressed_writer(file):
+    # the caller closes file after closing the returned writer
+    if zstandard:
+        return zstandard.ZstdCompressor(level=MANIFEST_CACHE_ZSTD_LEVEL).stream_writer(file, closefd=False)
+    return gzip.GzipFile(fileobj=file, mode='wb')
+
+COMPRESSED_SUFFIX = '.zst' if zstandard else '.gz'
+
+class ChecksumMismatchError(Exception):
+    pass
+
+class UnexpectedStatusError(Exception):
+    
+    def __init__(self, status):
+        super().__init__(f'Unexpected HTTP status: {status}')
+        self.status = status
+
+class InsufficientDiskSpaceError(Exception):
+    pass
+
+class DiskSpacePlan:
+    
+    def __init__(self, download_size=0, staging_size=0, growth_size=0):
+        # bytes fetched from the cdn
+        self.download_size = download_size
+        # bytes held in temp_folder and patch_folder at the peak of the job
+        self.staging_size = staging_size
+        # bytes the game folder grows by once the job is done, negative if it shrinks
+        self.growth_size = growth_size
+
+def preallocate_file(file, size):
+    # reserving the final size up front lets the filesystem lay the file out in one piece
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(file.fileno(), 0, size)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS):
+                raise
+    file.truncate(size)
+
+class FileWriter:
+    # network threads fill buffers from a bounded pool, a single thread hashes and writes them
+    
+    def __init__(self, file, buffer_size=WRITE_BUFFER_SIZE, buffer_count=WRITE_BUFFER_COUNT, md5_hash=None, on_written=None):
+        self.file = file
+        self.md5_hash = md5_hash
+        self.on_written = on_written
+        self.free_buffers = queue.SimpleQueue()
+        for _ in range(buffer_count):
+            self.free_buffers.put(bytearray(buffer_size))
+        self.pending = queue.SimpleQueue()
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='FileWriter', daemon=True)
+        self.thread.start()
+    
+    def get_buffer(self):
+        # blocks while every buffer is queued, so a slow disk holds back the network reads
+        if self.error:
+            raise self.error
+        return self.free_buffers.get()
+    
+    def release_buffer(self, buffer):
+        self.free_buffers.put(buffer)
+    
+    def write(self, buffer, size, offset, context=None):
+        if self.error:
+            self.free_buffers.put(buffer)
+            raise self.error
+        self.pending.put((buffer, size, offset, context))
+    
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            buffer, size, offset, context = item
+            try:
+                if self.error is None:
+                    view = memoryview(buffer)[:size]
+                    self.file.seek(offset)
+                    self.file.write(view)
+                    if self.md5_hash:
+                        self.md5_hash.update(view)
+                    if self.on_written:
+                        self.on_written(offset, view, context)
+                    view.release()
+            except Exception as e:
+                self.error = e
+            finally:
+                self.free_buffers.put(buffer)
+    
+    def close(self, sync=True):
+        self.pending.put(None)
+        self.thread.join()
+        if self.error:
+            raise self.error
+        if sync:
+            os.fsync(self.file.fileno())
+
+class DownloadJournal:
+    # .temp.segments of a preallocated file: the byte ranges written so far, a crc32 of every
+    # finished block and the server's ETag / Last-Modified, sent as If-Range when resuming
+    
+    def __init__(self, journal_path, size, segments, block_size=JOURNAL_BLOCK_SIZE, blocks=None, validator=None):
+        self.journal_path = journal_path
+        self.size = size
+        self.segments = segments
+        self.block_size = block_size
+        self.blocks = blocks or {}
+        self.validator = validator
+        # block -> (crc32, bytes) of blocks still being written
+        self.partial_blocks = {}
+        self.unsaved_bytes = 0
+        # False for a journal loaded from disk until its blocks have been read back
+        self.verified = True
+    
+    @classmethod
+    def create(cls, journal_path, size, segment_count, done=0):
+        # segments start on block boundaries, so every block is written by one segment from its start
+        segment_size = -(-size // segment_count)
+        segment_size = -(-segment_size // JOURNAL_BLOCK_SIZE) * JOURNAL_BLOCK_SIZE
+        segments = [
+            {'start': start, 'end': min(start + segment_size, size) - 1, 'done': 0}
+            for start in range(0, size, segment_size)
+        ]
+        segments[0]['done'] = done
+        return cls(journal_path, size, segments)
+    
+    @classmethod
+    def load(cls, journal_path, size):
+        if not journal_path.exists():
+            return None
+        try:
+            with open(journal_path, 'r', encoding='utf-8') as file:
+                state = json.load(file)
+            if state.get('size') != size or not state.get('segments'):
+                return None
+            blocks = {int(block): crc for block, crc in state.get('blocks', {}).items()}
+            journal = cls(journal_path, size, state['segments'], state.get('block_size', JOURNAL_BLOCK_SIZE),
+                          blocks, state.get('validator'))
+        except (OSError, ValueError, TypeError, AttributeError):
+            return None
+        journal.verified = False
+        return journal
+    
+    def save(self):
+        temp_journal_path = self.journal_path.with_name(self.journal_path.name + '.tmp')
+        with open(temp_journal_path, 'w', encoding='utf-8') as file:
+            json.dump({
+                'size': self.size,
+                'segments': self.segments,
+                'block_size': self.block_size,
+                'blocks': self.blocks,
+                'validator': self.validator,
+            }, file)
+        os.replace(temp_journal_path, self.journal_path)
+    
+    @property
+    def done_size(self):
+        return sum(segment['done'] for segment in self.segments)
+    
+    def pending_segments(self):
+        return [segment for segment in self.segments if segment['start'] + segment['done'] <= segment['end']]
+    
+    def reset(self, segment_count=1):
+        # the remote file changed, nothing written so far is worth keeping
+        fresh = DownloadJournal.create(self.journal_path, self.size, segment_count)
+        self.segments = fresh.segments
+        self.blocks = {}
+        self.partial_blocks = {}
+        self.validator = None
+    
+    def block_length(self, block):
+        return min(self.block_size, self.size - block * self.block_size)
+    
+    def record(self, offset, data, segment):
+        # runs on the writer thread, the only one that moves segment['done'], so the journal matches the disk
+        position = 0
+        while position < len(data):
+            block = (offset + position) // self.block_size
+            block_offset = offset + position - block * self.block_size
+            size = min(len(data) - position, self.block_length(block) - block_offset)
+            crc, length = self.partial_blocks.pop(block, (0, 0))
+            if length == block_offset:
+                crc = zlib.crc32(data[position:position + size], crc)
+                length += size
+                if length == self.block_length(block):
+                    self.blocks[block] = crc
+                else:
+                    self.partial_blocks[block] = (crc, length)
+            position += size
+        segment['done'] += len(data)
+        self.unsaved_bytes += len(data)
+        if self.unsaved_bytes >= SEGMENT_STATE_INTERVAL:
+            self.save()
+            self.unsaved_bytes = 0
+    
+    def verify(self, temp_file_path, split=True, md5_hash=None, wait=None):
+        # written blocks are re-read and checked, any block that fails is fetched again; returns the
+        # blocks whose checksum did not match, the unfinished block at a write frontier is not one of them
+        damaged_blocks = []
+        corrupt_blocks = []
+        buffer = bytearray(self.block_size)
+        view = memoryview(buffer)
+        with open(temp_file_path, 'rb', buffering=0) as file:
+            for segment in self.segments:
+                first_block = segment['start'] // self.block_size
+                last_block = (segment['start'] + segment['done']) // self.block_size
+                for block in range(first_block, last_block + 1):
+                    start = block * self.block_size
+                    length = min(self.block_length(block), segment['start'] + segment['done'] - start)
+                    if length <= 0:
+                        break
+                    file.seek(start)
+                    size = file.readinto(view[:length])
+                    if length == self.block_length(block) and size == length and zlib.crc32(view[:length]) == self.blocks.get(block):
+                        if md5_hash:
+                            md5_hash.update(view[:length])
+                        if wait:
+                            wait()
+                        continue
+                    damaged_blocks.append(block)
+                    if block in self.blocks:
+                        corrupt_blocks.append(block)
+                    if not split:
+                        # a single stream can only go on from the first damaged block
+                        segment['done'] = start - segment['start']
+                        break
+        for block in damaged_blocks:
+            self.blocks.pop(block, None)
+        if split and damaged_blocks:
+            self.segments = self.split_segments(set(damaged_blocks))
+        return corrupt_blocks
+    
+    def split_segments(self, damaged_blocks):
+        # runs of damaged blocks become segments of their own, the good ranges around them stay done
+        segments = []
+        for segment in self.segments:
+            written_end = segment['start'] + segment['done']
+            runs = []
+            for block in sorted(damaged_blocks):
+                block_start = block * self.block_size
+                if not segment['start'] <= block_start < written_end:
+                    continue
+                block_end = min(block_start + self.block_length(block), segment['end'] + 1)
+                if runs and runs[-1][1] == block_start:
+                    runs[-1][1] = block_end
+                else:
+                    runs.append([block_start, block_end])
+            
+            position = segment['start']
+            for run_start, run_end in runs:
+                if run_start > position:
+                    segments.append({'start': position, 'end': run_start - 1, 'done': run_start - position})
+                if run_end >= written_end:
+                    # a run reaching the write frontier is where the rest of the segment starts again
+                    written_end = position = run_start
+                    break
+                segments.append({'start': run_start, 'end': run_end - 1, 'done': 0})
+                position = run_end
+            if position <= segment['end']:
+                segments.append({'start': position, 'end': segment['end'], 'done': max(0, written_end - position)})
+        return segments
+
+def response_validator(rsp):
+    # If-Range needs a strong ETag, Last-Modified is the fallback
+    etag = rsp.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return rsp.headers.get('Last-Modified')
+
+def copy_file(source, destination):
+    # the kernel copies the data without a round trip through user space where it can
+    temp_path = f'{destination}.temp'
+    with open(source, 'rb') as src, open(temp_path, 'wb') as dst:
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while os.copy_file_range(src.fileno(), dst.fileno(), COPY_CHUNK_SIZE):
+                    pass
+            except OSError as e:
+                # old kernels and some filesystems refuse, the rest is copied below
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+        shutil.copyfileobj(src, dst, HASH_BUFFER_SIZE)
+    os.replace(temp_path, destination)
+
+def move_file(source, destination):
+    # a rename when staging shares the filesystem, a copy when it does not
+    try:
+        os.replace(source, destination)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    copy_file(source, destination)
+    os.unlink(source)
+
+def clone_file(source, destination):
+    # a reflink is a copy-on-write copy, nothing is written until one side changes
+    if fcntl is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflinks are not supported on this platform')
+    with open(source, 'rb') as src, open(destination, 'xb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except OSError:
+            dst.close()
+            os.unlink(destination)
+            raise
+
+def link_file(source, destination):
+    # a hardlink where the filesystem allows it, otherwise a reflink; neither copies any data
+    try:
+        os.link(source, destination)
+    except FileExistsError:
+        raise
+    except OSError:
+        clone_file(source, destination)
+
+class ContentStore:
+    
+    def __init__(self, store_path, max_size=0):
+        # blobs are named by md5 and shared with the game folders by hardlink or reflink
+        self.store_path = Path(store_path)
+        self.store_path.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.hash_cache = HashCache(self.store_path / 'storeHashCache.json')
+    
+    def blob_path(self, md5):
+        return self.store_path / md5[:2] / md5
+    
+    def materialize(self, md5, size, file_path, get_md5):
+        blob_path = self.blob_path(md5)
+        try:
+            if os.path.getsize(blob_path) != size:
+                return False
+        except OSError:
+            return False
+        # a hardlinked blob is the installed file, a write to it in any game folder shows up here
+        if self.hash_cache.lookup(md5, blob_path) != md5:
+            if get_md5(blob_path) != md5:
+                logger.warning(f"Removing damaged blob {blob_path} from the content store")
+                blob_path.unlink(missing_ok=True)
+                self.hash_cache.forget(md5)
+                return False
+            self.hash_cache.record(md5, blob_path, md5)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_file_path = file_path.with_name(f'{file_path.name}.temp')
+        temp_file_path.unlink(missing_ok=True)
+        file_path.with_name(f'{file_path.name}.temp.segments').unlink(missing_ok=True)
+        try:
+            link_file(blob_path, temp_file_path)
+        except OSError as e:
+            logger.debug(f"Cannot link {blob_path} to {file_path}: {e}")
+            return False
+        os.replace(temp_file_path, file_path)
+        return True
+    
+    def add(self, md5, file_path):
+        # the caller has verified file_path against md5
+        blob_path = self.blob_path(md5)
+        if blob_path.exists():
+            return
+        blob_path.parent.mkdir(exist_ok=True)
+        try:
+            link_file(file_path, blob_path)
+        except FileExistsError:
+            return
+        except OSError as e:
+            logger.debug(f"Cannot add {file_path} to the content store: {e}")
+            return
+        self.hash_cache.record(md5, blob_path, md5)
+    
+    def evict(self):
+        # blobs with a single link are not used by any install; linking touches ctime, so the
+        # least recently used go first
+        if not self.max_size:
+            return
+        total_size = 0
+        unused_blobs = []
+        for folder in os.scandir(self.store_path):
+            if not folder.is_dir() or len(folder.name) != 2:
+                continue
+            for entry in os.scandir(folder.path):
+                stat = entry.stat()
+                total_size += stat.st_size
+                if stat.st_nlink == 1:
+                    unused_blobs.append((stat.st_ctime, stat.st_size, entry.path, entry.name))
+        unused_blobs.sort()
+        evicted_count = 0
+        evicted_size = 0
+        for _, size, path, md5 in unused_blobs:
+            if total_size <= self.max_size:
+                break
+            os.unlink(path)
+            self.hash_cache.forget(md5)
+            total_size -= size
+            evicted_count += 1
+            evicted_size += size
+        if evicted_count:
+            logger.info(f"Evicted {evicted_count} unused blobs ({format_size(evicted_size)}) from the content store")
+        self.hash_cache.save()
+
+def parse_byte_range(range_header, size):
+    # (start, end) of a single 'bytes=' range, None if it is unsatisfiable; ValueError for
+    # anything else, such as multiple ranges, which is answered with the whole file
+    unit, _, spec = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        raise ValueError(f'unsupported range {range_header!r}')
+    first, _, last = spec.strip().partition('-')
+    if not first:
+        suffix = int(last)
+        if suffix <= 0 or size == 0:
+            return None
+        return max(size - suffix, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return None
+    return start, end
+
+class MirrorRequestHandler(BaseHTTPRequestHandler):
+    # keep-alive, the download side reuses its connections
+    protocol_version = 'HTTP/1.1'
+    server_version = 'LutheringLaves'
+    
+    def do_GET(self):
+        self.send_resource()
+    
+    def do_HEAD(self):
+        self.send_resource(head=True)
+    
+    def send_resource(self, head=False):
+        path = unquote(urlsplit(self.path).path)
+        if path == '/' + MIRROR_INFO_PATH:
+            body = json.dumps(self.server.info).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if not head:
+                self.wfile.write(body)
+            return
+        
+        # only files of the manifest are served, which also keeps requests inside the game folder
+        prefix = f'/{self.server.resources_base_path.strip("/")}/'
+        resource = self.server.manifest.get(path[len(prefix):]) if path.startswith(prefix) else None
+        if resource is None:
+            self.send_error(404)
+            return
+        try:
+            file = open(self.server.game_folder_path / resource.dest, 'rb')
+        except OSError:
+            self.send_error(404)
+            return
+        with file:
+            size = os.fstat(file.fileno()).st_size
+            if size != resource.size:
+                # the file is being repaired or was changed locally, the client goes to the cdn
+                self.send_error(404)
+                return
+            etag = f'"{resource.md5}"'
+            start, end = 0, size - 1
+            status = 200
+            range_header = self.headers.get('Range')
+            if_range = self.headers.get('If-Range')
+            if range_header and (not if_range or if_range == etag):
+                try:
+                    byte_range = parse_byte_range(range_header, size)
+                except ValueError:
+                    byte_range = (start, end)
+                else:
+                    status = 206
+                if byte_range is None:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                start, end = byte_range
+            length = end - start + 1
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(length))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            if status == 206:
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            self.end_headers()
+            if not head and length > 0:
+                self.connection.sendfile(file, start, length)
+    
+    def log_message(self, format, *args):
+        mirror_logger.debug(f'{self.address_string()} {format % args}')
+
+class MirrorServer(ThreadingHTTPServer):
+    daemon_threads = True
+    
+    def __init__(self, server_address, game_folder_path, resources_base_path, manifest, version):
+        super().__init__(server_address, MirrorRequestHandler)
+        self.game_folder_path = game_folder_path
+        self.resources_base_path = resources_base_path
+        self.manifest = manifest
+        self.info = {'version': version, 'resourcesBasePath': resources_base_path}
+
+class LauncherDaemon:
+    
+    JOBS = ('install', 'update', 'verify', 'patch-update')
+    
+    def __init__(self, launcher):
+        # one job at a time on the long-lived launcher; progress and job changes fan out to event streams
+        self.launcher = launcher
+        self.lock = threading.Lock()
+        self.job = None
+        self.job_thread = None
+        # the last check-update, kept apart so it does not hide the result of the last job
+        self.check = None
+        self.subscribers = []
+        self.last_progress = {}
+        launcher.set_progress_callback(self.on_progress)
+    
+    def subscribe(self):
+        events = queue.Queue(maxsize=DAEMON_EVENT_QUEUE_SIZE)
+        with self.lock:
+            self.subscribers.append(events)
+        return events
+    
+    def unsubscribe(self, events):
+        with self.lock:
+            self.subscribers.remove(events)
+    
+    def publish(self, event):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for events in subscribers:
+            while True:
+                try:
+                    events.put_nowait(event)
+                    break
+                except queue.Full:
+                    # a slow reader loses the oldest events, the next status or progress event catches it up
+                    try:
+                        events.get_nowait()
+                    except queue.Empty:
+                        pass
+    
+    def on_progress(self, snapshot):
+        progress = snapshot._asdict()
+        with self.lock:
+            self.last_progress[snapshot.flag] = progress
+        self.publish({'event': 'progress', **progress})
+    
+    def status(self):
+        launcher = self.launcher
+        with self.lock:
+            job = dict(self.job) if self.job else None
+            check = dict(self.check) if self.check else None
+            progress = dict(self.last_progress)
+        return {
+            'state': launcher.state.name,
+            'local_version': launcher.local_version,
+            'current_version': launcher.current_version,
+            'support_incremental_patching': launcher.support_incremental_patching,
+            'paused': launcher.is_paused(),
+            'job': job,
+            'check_update': check,
+            'progress': progress,
+        }
+    
+    def check_idle(self):
+        # called with self.lock held; a running refresh counts too, no job may start while the manifest is swapped
+        for record in (self.job, self.check):
+            if record and record['finished'] is None:
+                raise RuntimeError(f"{record['name']} is running")
+    
+    def finish_job(self, failed_files=None, error=None):
+        with self.lock:
+            self.job.update(finished=time.time(), failed_files=list(failed_files or []), error=error)
+            return dict(self.job)
+    
+    def check_update(self):
+        with self.lock:
+            self.check_idle()
+            self.check = {'name': 'check-update', 'started': time.time(), 'finished': None, 'error': None}
+        error = None
+        try:
+            self.launcher.refresh()
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            with self.lock:
+                self.check.update(finished=time.time(), error=error)
+        status = self.status()
+        self.publish({'event': 'status', **status})
+        return status
+    
+    def start_job(self, name):
+        with self.lock:
+            self.check_idle()
+            self.job = {'name': name, 'started': time.time(), 'finished': None, 'failed_files': None, 'error': None}
+            self.last_progress = {}
+            self.job_thread = threading.Thread(target=self.run_job, args=(name,), name=f'daemon-{name}', daemon=True)
+            self.job_thread.start()
+        self.publish({'event': 'job', **self.job})
+        return dict(self.job)
+    
+    def run_job(self, name):
+        launcher = self.launcher
+        failed_files = None
+        error = None
+        try:
+            if name == 'install':
+                failed_files = launcher.download_game() or launcher.verify_gamefile()
+            elif name == 'update':
+                failed_files = launcher.update_game()
+            elif name == 'verify':
+                failed_files = launcher.verify_gamefile()
+            elif name == 'patch-update':
+                if not launcher.support_incremental_patching:
+                    raise RuntimeError(f'No incremental patch from {launcher.local_version} to {launcher.current_version}')
+                failed_files = launcher.download_patch()
+                if not failed_files:
+                    failed_files = launcher.merge_patch()
+        except Exception as e:
+            logger.error(f"Daemon job {name} failed: {e}", exc_info=True)
+            error = str(e)
+        finally:
+            launcher.save_metrics()
+            launcher.init_launcher_state()
+        job = self.finish_job(failed_files=failed_files, error=error)
+        self.publish({'event': 'job', **job})
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'LutheringLaves'
+    
+    def check_host(self):
+        # a page that rebinds its own name to 127.0.0.1 becomes same-origin and could send anything,
+        # but its requests still carry that name as Host
+        allowed_hosts = self.server.allowed_hosts
+        if allowed_hosts is None or (self.headers.get('Host') or '').lower() in allowed_hosts:
+            return True
+        self.send_json(403, {'error': 'Host not allowed'})
+        return False
+    
+    def do_GET(self):
+        if not self.check_host():
+            return
+        path = urlsplit(self.path).path.rstrip('/')
+        if path == '/status':
+            self.send_json(200, self.server.daemon.status())
+        elif path == '/events':
+            self.send_events()
+        else:
+            self.send_json(404, {'error': f'unknown endpoint {path}'})
+    
+    def do_POST(self):
+        daemon = self.server.daemon
+        path = urlsplit(self.path).path.rstrip('/')
+        # the body is not used, it is read so the connection can be kept alive
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if not self.check_host():
+            return
+        # a web page can post a form to 127.0.0.1 but not send a json content type without a preflight,
+        # which is not answered, so this keeps browsers from starting jobs
+        if self.headers.get_content_type() != 'application/json':
+            self.send_json(415, {'error': 'Content-Type must be application/json'})
+            return
+        try:
+            if path == '/check-update':
+                self.send_json(200, daemon.check_update())
+            elif path.lstrip('/') in LauncherDaemon.JOBS:
+                self.send_json(202, daemon.start_job(path.lstrip('/')))
+            elif path == '/pause':
+                daemon.launcher.pause()
+                self.send_json(200, daemon.status())
+            elif path == '/resume':
+                daemon.launcher.resume()
+                self.send_json(200, daemon.status())
+            else:
+                self.send_json(404, {'error': f'unknown endpoint {path}'})
+        except RuntimeError as e:
+            self.send_json(409, {'error': str(e)})
+    
+    def send_json(self, status, data):
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def send_events(self):
+        # newline delimited json until the client goes away, starting with the current status
+        daemon = self.server.daemon
+        events = daemon.subscribe()
+        self.close_connection = True
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            event = {'event': 'status', **daemon.status()}
+            while True:
+                self.wfile.write(json.dumps(event, ensure_ascii=False).encode('utf-8') + b'\n')
+                self.wfile.flush()
+                try:
+                    event = events.get(timeout=DAEMON_EVENT_PING_INTERVAL)
+                except queue.Empty:
+                    event = {'event': 'ping'}
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            daemon.unsubscribe(events)
+    
+    def log_message(self, format, *args):
+        logger.debug(f'daemon: {format % args}')
+
+class DaemonHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    
+    def __init__(self, server_address, daemon):
+        super().__init__(server_address, DaemonRequestHandler)
+        self.daemon = daemon
+        host, port = server_address[0], self.server_address[1]
+        hosts = {'127.0.0.1', 'localhost', '[::1]'}
+        if host and host not in ('0.0.0.0', '::'):
+            hosts.add(f'[{host}]' if ':' in host else host)
+        self.allowed_hosts = {f'{name.lower()}:{port}' for name in hosts}
+
+class DaemonUnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    
+    def __init__(self, socket_path, daemon):
+        super().__init__(socket_path, DaemonRequestHandler)
+        self.daemon = daemon
+        # browsers cannot reach a unix socket
+        self.allowed_hosts = None
+    
+    def get_request(self):
+        # http.server expects a (host, port) client address
+        request, _ = super().get_request()
+        return request, ('local', 0)
+
+class HashCache:
+    
+    def __init__(self, cache_file_path):
+        self.cache_file_path = cache_file_path
+        self.lock = threading.Lock()
+        # serializes writers of the shared .tmp file, held apart from lock so lookups never wait on the disk
+        self.save_lock = threading.Lock()
+        self.entries = {}
+        self.unsaved_count = 0
+        self.load()
+    
+    def load(self):
+        if not self.cache_file_path.exists():
+            return
+        try:
+            with open(self.cache_file_path, 'r', encoding='utf-8') as file:
+                self.entries = json.load(file).get('files', {})
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable hash cache {self.cache_file_path}: {e}")
+            self.entries = {}
+    
+    def save(self):
+        # called once at the end of a download or hashing pass, not from the workers
+        with self.save_lock:
+            with self.lock:
+                if not self.unsaved_count:
+                    return
+                data = json.dumps({'files': self.entries}, ensure_ascii=False)
+                self.unsaved_count = 0
+            temp_file_path = self.cache_file_path.with_name(self.cache_file_path.name + '.tmp')
+            with open(temp_file_path, 'w', encoding='utf-8') as file:
+                file.write(data)
+            os.replace(temp_file_path, self.cache_file_path)
+    
+    def file_key(self, file_path):
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+    
+    def lookup(self, dest, file_path):
+        key = self.file_key(file_path)
+        if key is None:
+            return None
+        with self.lock:
+            entry = self.entries.get(dest)
+        if entry and entry['key'] == key:
+            return entry['md5']
+        return None
+    
+    def record(self, dest, file_path, md5):
+        key = self.file_key(file_path)
+        if key is None:
+            return
+        with self.lock:
+            self.entries[dest] = {'key': key, 'md5': md5}
+            self.unsaved_count += 1
+    
+    def forget(self, dest):
+        with self.lock:
+            if self.entries.pop(dest, None) is not None:
+                self.unsaved_count += 1
+
+class TLSSessionContext(ssl.SSLContext):
+    # hands the last TLS session of a host to new connections so they skip the full handshake
+    
+    def wrap_socket(self, sock, *args, server_hostname=None, session=None, **kwargs):
+        sessions = self.__dict__.setdefault('sessions', {})
+        if session is None:
+            session = sessions.get(server_hostname)
+        try:
+            ssl_sock = super().wrap_socket(sock, *args, server_hostname=server_hostname, session=session, **kwargs)
+        except ssl.SSLError:
+            if session is None:
+                raise
+            sessions.pop(server_hostname, None)
+            ssl_sock = super().wrap_socket(sock, *args, server_hostname=server_hostname, **kwargs)
+        self.remember_session(server_hostname, ssl_sock)
+        return ssl_sock
+    
+    def remember_session(self, server_hostname, ssl_sock):
+        if server_hostname and getattr(ssl_sock, 'session', None) is not None:
+            self.__dict__.setdefault('sessions', {})[server_hostname] = ssl_sock.session
+
+def parse_size(text):
+    # "512K", "2.5M" and "1G" are bytes, "0" usually means no limit
+    text = str(text).strip().upper().removesuffix('B')
+    multiplier = 1
+    if text and text[-1] in 'KMG':
+        multiplier = 1024 ** ('KMG'.index(text[-1]) + 1)
+        text = text[:-1]
+    size = float(text or 0) * multiplier
+    if size < 0:
+        raise ValueError(f"Negative size: {text}")
+    return int(size)
+
+def parse_rate(text):
+    # "0" means unlimited, "512K", "2.5M" and "1G" are bytes per second
+    return parse_size(str(text).strip().upper().removesuffix('/S'))
+
+class BandwidthLimiter:
+    # token bucket kept as the time the bucket is next free (GCRA): reads reserve their
+    # bytes in arrival order, so connections reading equal quanta get equal shares
+    
+    def __init__(self, rate=0, burst=BANDWIDTH_BURST):
+        self.condition = threading.Condition()
+        self.rate = rate
+        self.burst = burst
+        self.next_free_time = 0.0
+    
+    def set_rate(self, rate):
+        with self.condition:
+            self.rate = max(0, int(rate))
+            self.next_free_time = time.monotonic()
+            # sleepers rescheduled under the old rate go on right away
+            self.condition.notify_all()
+    
+    def consume(self, size):
+        with self.condition:
+            rate = self.rate
+            if rate <= 0 or size <= 0:
+                return
+            start = max(self.next_free_time, time.monotonic())
+            self.next_free_time = start + size / rate
+            deadline = self.next_free_time - self.burst
+            while rate == self.rate:
+                delay = deadline - time.monotonic()
+                if delay <= 0:
+                    return
+                self.condition.wait(delay)
+
+class PooledResponse:
+    
+    def __init__(self, pool, key, conn, rsp, url, limiter=None):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.rsp = rsp
+        self.url = url
+        self.limiter = limiter
+        self.status = rsp.status
+        self.reason = rsp.reason
+        self.headers = rsp.msg
+    
+    def read(self, amt=None):
+        if self.limiter is None or not self.limiter.rate:
+            return self.rsp.read(amt)
+        if amt is None:
+            chunks = []
+            while True:
+                chunk = self.read(BANDWIDTH_QUANTUM)
+                if not chunk:
+                    return b''.join(chunks)
+                chunks.append(chunk)
+        data = self.rsp.read(min(amt, BANDWIDTH_QUANTUM))
+        self.limiter.consume(len(data))
+        return data
+    
+    def readinto(self, buffer):
+        if self.limiter is None or not self.limiter.rate:
+            return self.rsp.readinto(buffer)
+        size = self.rsp.readinto(memoryview(buffer)[:BANDWIDTH_QUANTUM])
+        self.limiter.consume(size)
+        return size
+    
+    def close(self):
+        if self.conn is None:
+            return
+        # only a fully read response leaves the connection ready for the next request
+        if self.rsp.isclosed() and not self.rsp.will_close:
+            self.pool.release(self.key, self.conn)
+        else:
+            self.rsp.close()
+            self.conn.close()
+        self.conn = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class HTTPConnectionPool:
+    
+    def __init__(self, pool_size=DEFAULT_HTTP_POOL_SIZE):
+        self.pool_size = pool_size
+        self.lock = threading.Lock()
+        self.idle_connections = {}
+        self.addresses = {}
+        self.ssl_context = TLSSessionContext(ssl.PROTOCOL_TLS_CLIENT)
+        self.ssl_context.load_default_certs()
+        # shared by every response read through the pool
+        self.limiter = BandwidthLimiter()
+    
+    def create_connection(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+        host, port = address
+        now = time.monotonic()
+        with self.lock:
+            cached = self.addresses.get(address)
+        if cached is None or cached[0] < now:
+            addrinfo = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+            cached = (now + DNS_CACHE_TTL, addrinfo)
+            with self.lock:
+                self.addresses[address] = cached
         
+        error = None
+        for family, socktype, proto, _, sockaddr in cached[1]:
+            sock = None
+            try:
+                sock = socket.socket(family, socktype, proto)
+                if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sockaddr)
+                return sock
+            except OSError as e:
+                error = e
+                if sock is not None:
+                    sock.close()
+        # the cached addresses are all unreachable, resolve again next time
+        with self.lock:
+            self.addresses.pop(address, None)
+        raise error if error else OSError(f"getaddrinfo returns an empty list for {host}")
+    
+    def connection_key(self, url):
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == 'https' else 80)
+        proxy = getproxies().get(scheme)
+        if proxy and proxy_bypass(parts.hostname):
+            proxy = None
+        return (scheme, parts.hostname, port, proxy)
+    
+    def new_connection(self, key, timeout):
+        scheme, host, port, proxy = key
+        if proxy:
+            proxy_parts = urlsplit(proxy if '://' in proxy else 'http://' + proxy)
+            connect_host, connect_port = proxy_parts.hostname, proxy_parts.port or 80
+        else:
+            connect_host, connect_port = host, port
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(connect_host, connect_port, timeout=timeout, context=self.ssl_context)
+            if proxy:
+                conn.set_tunnel(host, port)
+        else:
+            conn = http.client.HTTPConnection(connect_host, connect_port, timeout=timeout)
+        conn._create_connection = self.create_connection
+        return conn
+    
+    def acquire(self, key, timeout):
+        with self.lock:
+            connections = self.idle_connections.get(key)
+            conn = connections.pop() if connections else None
+        if conn is None:
+            return self.new_connection(key, timeout), False
+        conn.timeout = timeout
+        try:
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+        except OSError:
+            conn.close()
+            return self.new_connection(key, timeout), False
+        return conn, True
+    
+    def release(self, key, conn):
+        if conn.sock is None:
+            return
+        if isinstance(conn.sock, ssl.SSLSocket):
+            self.ssl_context.remember_session(key[1], conn.sock)
+        with self.lock:
+            connections = self.idle_connections.setdefault(key, [])
+            if len(connections) < self.pool_size:
+                connections.append(conn)
+                return
+        conn.close()
+    
+    def request(self, url, headers=None, timeout=10, method='GET', throttle=True):
+        headers = dict(headers or {})
+        for _ in range(MAX_REDIRECTS + 1):
+            key = self.connection_key(url)
+            parts = urlsplit(url)
+            target = parts.path or '/'
+            if parts.query:
+                target += '?' + parts.query
+            if key[3] and key[0] == 'http':
+                target = url
+            
+            while True:
+                conn, reused = self.acquire(key, timeout)
+                try:
+                    conn.request(method, target, headers=headers)
+                    rsp = conn.getresponse()
+                    break
+                except (http.client.RemoteDisconnected, http.client.BadStatusLine, ConnectionResetError, BrokenPipeError) as e:
+                    conn.close()
+                    # an idle keep-alive connection was dropped by the server, retry on a new one
+                    if not reused:
+                        raise
+                    logger.debug(f"Reconnecting to {key[1]}: {e}")
+                except Exception:
+                    conn.close()
+                    raise
+            
+            response = PooledResponse(self, key, conn, rsp, url, limiter=self.limiter if throttle else None)
+            location = rsp.getheader('Location')
+            if rsp.status in (301, 302, 303, 307, 308) and location:
+                rsp.read()
+                response.close()
+                url = urljoin(url, quote(location, safe=":/?&=%#+@;,"))
+                continue
+            return response
+        raise IOError(f"Too many redirects: {url}")
+    
+    def close(self):
+        with self.lock:
+            connections = [conn for conns in self.idle_connections.values() for conn in conns]
+            self.idle_connections.clear()
+        for conn in connections:
+            conn.close()
+
+class CdnStats:
+    
+    def __init__(self, stats_file_path):
+        self.stats_file_path = stats_file_path
+        self.lock = threading.Lock()
+        self.nodes = {}
+        self.load()
+    
+    def load(self):
+        if not self.stats_file_path.exists():
+            return
+        try:
+            with open(self.stats_file_path, 'r', encoding='utf-8') as file:
+                self.nodes = json.load(file).get('nodes', {})
+        except (OSError, ValueError) as e:
+            cdn_logger.warning(f"Ignoring unreadable cdn stats {self.stats_file_path}: {e}")
+            self.nodes = {}
+    
+    def save(self):
+        with self.lock:
+            data = json.dumps({'nodes': self.nodes}, ensure_ascii=False, indent=4)
+        temp_file_path = self.stats_file_path.with_name(self.stats_file_path.name + '.tmp')
+        try:
+            with open(temp_file_path, 'w', encoding='utf-8') as file:
+                file.write(data)
+            os.replace(temp_file_path, self.stats_file_path)
+        except OSError as e:
+            cdn_logger.warning(f"Failed to save cdn stats: {e}")
+    
+    def record(self, url, latency=None, throughput=None):
+        now = time.time()
+        with self.lock:
+            node = self.nodes.setdefault(url, {'latency': latency, 'throughput': throughput, 'updated': now})
+            # older measurements lose half of their weight every CDN_STATS_HALF_LIFE seconds
+            weight = 0.5 * 0.5 ** (max(0, now - node['updated']) / CDN_STATS_HALF_LIFE)
+            if latency is not None:
+                old = node.get('latency')
+                node['latency'] = latency if old is None else weight * old + (1 - weight) * latency
+            if throughput is not None:
+                old = node.get('throughput')
+                node['throughput'] = throughput if old is None else weight * old + (1 - weight) * throughput
+            node['updated'] = now
+    
+    def throughput(self, url):
+        with self.lock:
+            node = self.nodes.get(url)
+            return node.get('throughput') if node else None
+    
+    def latency(self, url):
+        with self.lock:
+            node = self.nodes.get(url)
+            return node.get('latency') if node else None
+
+class Metrics:
+    
+    def __init__(self):
+        # counters, gauges and histograms keyed by name and sorted labels, written at the end of a run
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+    
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+    
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+    
+    def observe(self, name, value, buckets=METRICS_SECONDS_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': buckets, 'counts': [0] * (len(buckets) + 1), 'count': 0, 'sum': 0}
+            histogram['counts'][bisect.bisect_left(histogram['buckets'], value)] += 1
+            histogram['count'] += 1
+            histogram['sum'] += value
+    
+    @contextmanager
+    def timer(self, name, **labels):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+    
+    def node_throughput(self):
+        # bytes per second of a single connection to each node, from the files it delivered
+        with self.lock:
+            seconds = {dict(labels)['node']: value for (name, labels), value in self.counters.items()
+                       if name == 'download_node_seconds_total'}
+            sizes = {dict(labels)['node']: value for (name, labels), value in self.counters.items()
+                     if name == 'download_node_bytes_total'}
+        return {node: sizes.get(node, 0) / seconds[node] for node in seconds if seconds[node] > 0}
+    
+    def summary(self):
+        for node, throughput in self.node_throughput().items():
+            self.set('download_node_throughput_bytes_per_second', throughput, node=node)
+        with self.lock:
+            def entries(items):
+                return [{'name': name, 'labels': dict(labels), 'value': value} for (name, labels), value in sorted(items.items())]
+            histograms = []
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(histogram['buckets'] + ('+Inf',), histogram['counts']):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                histograms.append({'name': name, 'labels': dict(labels), 'count': histogram['count'],
+                                   'sum': histogram['sum'], 'buckets': buckets})
+            return {
+                'start_time': self.start_time,
+                'duration': time.time() - self.start_time,
+                'counters': entries(self.counters),
+                'gauges': entries(self.gauges),
+                'histograms': histograms,
+            }
+    
+    @staticmethod
+    def prometheus_labels(labels, **extra):
+        labels = {**labels, **extra}
+        if not labels:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+        return '{' + ','.join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + '}'
+    
+    def prometheus_text(self, summary):
+        lines = []
+        typed = set()
+        def add(kind, name, entry_name, labels, value):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{entry_name}{self.prometheus_labels(labels)} {value}')
+        for entry in summary['counters']:
+            name = f"{METRICS_PREFIX}_{entry['name']}"
+            add('counter', name, name, entry['labels'], entry['value'])
+        for entry in summary['gauges']:
+            name = f"{METRICS_PREFIX}_{entry['name']}"
+            add('gauge', name, name, entry['labels'], entry['value'])
+        for entry in summary['histograms']:
+            name = f"{METRICS_PREFIX}_{entry['name']}"
+            for bound, count in entry['buckets'].items():
+                add('histogram', name, f'{name}_bucket', {**entry['labels'], 'le': bound}, count)
+            add('histogram', name, f'{name}_sum', entry['labels'], entry['sum'])
+            add('histogram', name, f'{name}_count', entry['labels'], entry['count'])
+        return '\n'.join(lines) + '\n'
+    
+    def save(self, json_file_path, textfile_path):
+        # the textfile collector of node_exporter may read at any time, so both files are replaced atomically
+        summary = self.summary()
+        for file_path, data in ((json_file_path, json.dumps(summary, indent=4)), (textfile_path, self.prometheus_text(summary))):
+            temp_file_path = file_path.with_name(file_path.name + '.tmp')
+            try:
+                with open(temp_file_path, 'w', encoding='utf-8') as file:
+                    file.write(data)
+                os.replace(temp_file_path, file_path)
+            except OSError as e:
+                logger.warning(f"Failed to save metrics to {file_path}: {e}")
+
+def measured(phase):
+    # times a Launcher method into the phase_seconds histogram
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.timer('phase_seconds', phase=phase):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+class RunProfiler:
+    
+    def __init__(self):
+        # before 3.12 cProfile only sees the thread that enables it, so every thread started later gets its own profiler;
+        # from 3.12 on it runs on sys.monitoring, sees every thread and only one can be active per interpreter
+        self.per_thread = sys.version_info < (3, 12)
+        self.lock = threading.Lock()
+        self.profilers = []
+    
+    def start(self):
+        tracemalloc.start()
+        if self.per_thread:
+            threading.setprofile(self.profile_thread)
+        self.profile_thread()
+    
+    def profile_thread(self, *args):
+        profiler = cProfile.Profile()
+        try:
+            # replaces the threading hook for the rest of the thread
+            profiler.enable()
+        except ValueError as e:
+            # another profiling tool is already active, the run goes on without this profiler
+            logger.warning(f"Failed to enable profiler: {e}")
+            return
+        with self.lock:
+            self.profilers.append(profiler)
+    
+    def stop(self, stats_file_path, report_file_path):
+        if self.per_thread:
+            threading.setprofile(None)
+        current_size, peak_size = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        for profiler in self.profilers:
+            profiler.disable()
+        
+        report = io.StringIO()
+        stats = None
+        for profiler in self.profilers:
+            try:
+                profile_stats = pstats.Stats(profiler, stream=report)
+            except TypeError:
+                # a thread that never ran any python code
+                continue
+            if stats is None:
+                stats = profile_stats
+            else:
+                stats.add(profile_stats)
+        if stats is not None:
+            stats.dump_stats(stats_file_path)
+            stats.sort_stats('cumulative').print_stats(PROFILE_REPORT_LINES)
+        report.write(f'tracemalloc: {format_size(current_size)} allocated at the end, {format_size(peak_size)} peak\n')
+        for statistic in snapshot.statistics('lineno')[:PROFILE_REPORT_LINES]:
+            report.write(f'{statistic}\n')
+        with open(report_file_path, 'w', encoding='utf-8') as file:
+            file.write(report.getvalue())
+        logger.info(f"Profile written to {stats_file_path} and {report_file_path}")
+
+class CircuitBreaker:
+    
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, cooldown=CIRCUIT_COOLDOWN):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.lock = threading.Lock()
+        self.failures = {}
+        self.open_until = {}
+    
+    def is_open(self, node_url):
+        with self.lock:
+            return self.open_until.get(node_url, 0) > time.monotonic()
+    
+    def record_success(self, node_url):
+        with self.lock:
+            self.failures.pop(node_url, None)
+            self.open_until.pop(node_url, None)
+    
+    def record_failure(self, node_url):
+        with self.lock:
+            self.failures[node_url] = self.failures.get(node_url, 0) + 1
+            if self.failures[node_url] >= self.failure_threshold:
+                self.open_until[node_url] = time.monotonic() + self.cooldown
+                self.failures[node_url] = 0
+                cdn_logger.warning(f"CDN node {node_url} failed {self.failure_threshold} times, skipped for {self.cooldown}s")
+    
+    def reopen_time(self, node_url):
+        with self.lock:
+            return self.open_until.get(node_url, 0)
+
+class ManifestCache:
+    
+    def __init__(self, cache_folder_path):
+        self.cache_folder_path = cache_folder_path
+        self.lock = threading.Lock()
+    
+    def entry_paths(self, url):
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return self.cache_folder_path / f'{name}.meta.json', self.cache_folder_path / f'{name}.json{COMPRESSED_SUFFIX}'
+    
+    def load_meta(self, url):
+        meta_file_path, data_file_path = self.entry_paths(url)
+        if not meta_file_path.exists() or not data_file_path.exists():
+            return None
+        try:
+            with open(meta_file_path, 'r', encoding='utf-8') as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            return None
+        return meta if meta.get('url') == url else None
+    
+    def open(self, url):
+        _, data_file_path = self.entry_paths(url)
+        return open_compressed(data_file_path)
+    
+    def load(self, url):
+        try:
+            with self.open(url) as file:
+                return file.read()
+        except Exception as e:
+            logger.warning(f"Failed to read cached manifest for {url}: {e}")
+            return None
+    
+    def writer(self, url, etag=None, last_modified=None):
+        return ManifestCacheWriter(self, url, etag=etag, last_modified=last_modified)
+    
+    def store(self, url, data, etag=None, last_modified=None):
+        try:
+            writer = self.writer(url, etag=etag, last_modified=last_modified)
+            writer.write(data)
+            writer.commit()
+        except OSError as e:
+            logger.warning(f"Failed to cache manifest for {url}: {e}")
+
+class ManifestCacheWriter:
+    
+    def __init__(self, cache, url, etag=None, last_modified=None):
+        self.cache = cache
+        self.url = url
+        self.meta = {'url': url, 'etag': etag, 'last_modified': last_modified}
+        self.meta_file_path, self.data_file_path = cache.entry_paths(url)
+        self.temp_file_path = self.data_file_path.with_name(f'{self.data_file_path.name}.{threading.get_ident()}.tmp')
+        cache.cache_folder_path.mkdir(parents=True, exist_ok=True)
+        self.file = open(self.temp_file_path, 'wb')
+        self.writer = compressed_writer(self.file)
+    
+    def write(self, data):
+        self.writer.write(data)
+    
+    def commit(self):
+        self.writer.close()
+        self.file.close()
+        with self.cache.lock:
+            os.replace(self.temp_file_path, self.data_file_path)
+            with open(self.meta_file_path, 'w', encoding='utf-8') as file:
+                json.dump(self.meta, file, ensure_ascii=False)
+    
+    def abort(self):
+        self.writer.close()
+        self.file.close()
+        if self.temp_file_path.exists():
+            self.temp_file_path.unlink()
+
+class ManifestResource:
+    __slots__ = ('dest', 'size', 'md5')
+    
+    def __init__(self, dest, size, md5):
+        self.dest = dest
+        self.size = size
+        self.md5 = md5
+
+class GameManifest:
+    
+    def __init__(self, resources):
+        self.resources = tuple(resources)
+        self.index = {resource.dest: i for i, resource in enumerate(self.resources)}
+        self.total_size = sum(resource.size for resource in self.resources)
+        self._largest_first = None
+    
+    def __len__(self):
+        return len(self.resources)
+    
+    def __iter__(self):
+        return iter(self.resources)
+    
+    def __contains__(self, dest):
+        return dest in self.index
+    
+    def get(self, dest):
+        i = self.index.get(dest)
+        return None if i is None else self.resources[i]
+    
+    def largest_first(self):
+        if self._largest_first is None:
+            self._largest_first = tuple(sorted(self.resources, key=lambda resource: resource.size, reverse=True))
+        return self._largest_first
+    
+    @staticmethod
+    def object_hook(obj):
+        # resource entries become slotted records while parsing, the dict-of-dicts never exists
+        if 'dest' in obj and 'md5' in obj and 'size' in obj:
+            return ManifestResource(obj['dest'], int(obj['size']), obj['md5'])
+        return obj
+    
+    def save(self, file_path, **extra):
+        temp_file_path = file_path.with_name(file_path.name + '.tmp')
+        with open(temp_file_path, 'wb') as file:
+            writer = compressed_writer(file)
+            header = json.dumps(extra, ensure_ascii=False)[1:-1]
+            writer.write(('{' + header + (', ' if header else '') + '"resource": [').encode('utf-8'))
+            for i, resource in enumerate(self.resources):
+                entry = json.dumps({'dest': resource.dest, 'size': resource.size, 'md5': resource.md5}, ensure_ascii=False)
+                writer.write(((', ' if i else '') + entry).encode('utf-8'))
+            writer.write(b']}')
+            writer.close()
+        os.replace(temp_file_path, file_path)
+    
+    @classmethod
+    def load_file(cls, file_path):
+        with open_compressed(file_path) as file:
+            return cls.load(file)
+    
+    @classmethod
+    def load(cls, stream):
+        # entries of the resource array are decoded one at a time as the text arrives, other keys are skipped
+        reader = JsonChunkReader(io.TextIOWrapper(io.BufferedReader(TeeStream(stream)), encoding='utf-8'))
+        resources = []
+        reader.expect('{')
+        if reader.peek() == '}':
+            return cls(resources)
+        while True:
+            key = reader.value()
+            reader.expect(':')
+            if key != 'resource':
+                reader.value()
+            elif reader.expect('[') and reader.peek() != ']':
+                while True:
+                    resources.append(reader.value(object_hook=cls.object_hook))
+                    if reader.expect(',]') == ']':
+                        break
+            else:
+                reader.expect(']')
+            if reader.expect(',}') == '}':
+                return cls(resources)
+
+class JsonChunkReader:
+    # decodes a json document value by value from a text stream, holding only the unparsed rest of a chunk
+    
+    WHITESPACE = re.compile(r'[ \t\n\r]*')
+    DELIMITERS = ' \t\n\r,:]}'
+    
+    def __init__(self, stream, chunk_size=MANIFEST_PARSE_CHUNK_SIZE):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+        self.decoders = {}
+    
+    def fill(self):
+        chunk = self.stream.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+    
+    def peek(self):
+        while True:
+            self.position = self.WHITESPACE.match(self.buffer, self.position).end()
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.fill():
+                return ''
+    
+    def expect(self, characters):
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError(f"Expected one of {characters!r}, got {character or 'end of data'!r}")
+        self.position += 1
+        return character
+    
+    def value(self, object_hook=None):
+        decoder = self.decoders.get(object_hook)
+        if decoder is None:
+            decoder = self.decoders[object_hook] = json.JSONDecoder(object_hook=object_hook)
+        self.peek()
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.position)
+                # a number cut off by the end of the chunk decodes as well ("-1." as -1),
+                # so only a value followed by a delimiter is known to be complete
+                if self.eof or (end < len(self.buffer) and self.buffer[end] in self.DELIMITERS):
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+class TeeStream(io.RawIOBase):
+    # reads from any object with read(size) and copies what passes through into sink
+    
+    def __init__(self, source, sink=None):
+        self.source = source
+        self.sink = sink
+    
+    def readable(self):
+        return True
+    
+    def readinto(self, buffer):
+        data = self.source.read(len(buffer))
+        if not data:
+            return 0
+        if self.sink is not None:
+            self.sink.write(data)
+        buffer[:len(data)] = data
+        return len(data)
+
 class Launcher:
     
     _instance = None
@@ -62,6 +1926,41 @@ class Launcher:
         if Launcher._initialized:
             return
         
+        # phase timings and counters of this run, see save_metrics
+        self.metrics = Metrics()
+        self.metrics_textfile_path = None
+        # keep-alive connections shared by manifest, image and file downloads
+        self.http_pool = HTTPConnectionPool()
+        # journals of partial downloads this process has written or already verified, by journal path;
+        # a retry picks them up as they are instead of re-reading every block
+        self.open_journals = {}
+        # last answer of every json api, revalidated with ETag / Last-Modified
+        self.manifest_cache = ManifestCache(Path(base_dir) / 'manifestCache')
+        
+        self.download_game_progress = ProgressInfo()
+        self.verify_game_progress = ProgressInfo()
+        self.update_game_progress = ProgressInfo()
+        self.update_game_progress_patch = ProgressInfo()
+        self.progress_callback = None
+        self.progress_reporter = None
+        # cleared while paused, download and hashing threads wait on it between chunks
+        self.resume_event = threading.Event()
+        self.resume_event.set()
+        # LAN mirror tried before the cdn, None when not configured or not serving this version
+        self.mirror_url = None
+        self.content_store = None
+        
+        self.init_launcher_settings()
+        
+        # background images never block install or update decisions
+        self.background_config = {
+            'background': 'background.webp',
+            'slogan': 'slogan.png'
+        }
+        self.background_ready = threading.Event()
+        # its own daemon thread, so a slow image server neither queues ahead of the manifests nor holds up exit
+        threading.Thread(target=self.init_background, daemon=True).start()
+        
         self.launcher_api = WW_LAUNCHER_API
         self.launcher_info = self.get_result(self.launcher_api)
         
@@ -69,7 +1968,14 @@ class Launcher:
             self.state = LauncherState.NETWORKERROR
             return
         
-        self.cdn_node = self.select_cdn()
+        self.cdn_stats = CdnStats(Path(base_dir) / 'cdnStats.json')
+        self.cdn_nodes = []
+        self.cdn_fallback_nodes = []
+        self.cdn_weights = {}
+        self.cdn_breaker = CircuitBreaker()
+        self.cdn_lock = threading.Lock()
+        # manifests are fetched from the static priority node while the nodes are being measured
+        self.cdn_node = self.priority_cdn_node()
         
         # create game folder
         self.game_folder_path = Path(base_dir) / Path(game_folder)
@@ -80,39 +1986,51 @@ class Launcher:
             
         self.temp_folder_path = None
         
-        # get last version game filelist
-        self.gamefile_index = self.get_gamefile_index()
+        # md5 of files already hashed, keyed by dest and invalidated by size/mtime/inode
+        self.hash_cache = HashCache(self.game_folder_path / 'launcherHashCache.json')
+        self.deep_verify = False
             
         # download url middle path
         self.resources_base_path = self.launcher_info['default']['resourcesBasePath'] if self.launcher_info else None
         self.current_version = self.launcher_info['default']['version'] if self.launcher_info else None
         self.local_version = self.get_localVersion()
         
-        self.download_game_progress = ProgressInfo()
-        self.verify_game_progress = ProgressInfo()
-        self.update_game_progress = ProgressInfo()
-        self.update_game_progress_patch = ProgressInfo()
-        
         self.support_incremental_patching = False
         self.target_patch = None
         self.gamefile_index_patch = None
         self.resources_base_path_patch = None
-        self.krdiff_file_path = None
-        self.progress_callback = None
+        # krdiff files are downloaded to patch_folder, hpatchz output and new files are staged in temp_folder
+        self.patch_folder_path = self.game_folder_path.parent / 'patch_folder'
+        self.temp_folder_path = self.game_folder_path.parent / 'temp_folder'
+        
+        # get last version game filelist, one worker per task so none of them waits behind another
+        init_executor = ThreadPoolExecutor(max_workers=4)
+        try:
+            select_cdn_future = init_executor.submit(self.select_cdn)
+            mirror_future = init_executor.submit(self.set_mirror, self.settings.get('mirror_url'))
+            gamefile_index_future = init_executor.submit(self.get_gamefile_index)
+            incremental_update_future = init_executor.submit(self.init_incremental_update)
+            self.gamefile_index = gamefile_index_future.result()
+            incremental_update_future.result()
+            mirror_future.result()
+            self.cdn_node = select_cdn_future.result() or self.cdn_node
+        finally:
+            init_executor.shutdown(wait=False, cancel_futures=True)
+        
+        if self.gamefile_index is None:
+            self.state = LauncherState.NETWORKERROR
+            return
         
         self.init_launcher_state()
-        self.init_incremental_update()
-        self.init_launcher_settings()
-        self.init_background()
     
+    @measured('init_launcher_state')
     def init_launcher_state(self):
         self.state = LauncherState.STARTGAME
         logger.info("set launcher state to STARTGAME")
         
         if self.local_version is None:
-            resource_list = list(self.gamefile_index['resource'])
-            for file in resource_list:
-                file_path = self.game_folder_path.joinpath(Path(file['dest']))
+            for file in self.gamefile_index:
+                file_path = self.game_folder_path.joinpath(Path(file.dest))
                 if not file_path.exists():
                     self.state = LauncherState.NEEDINSTALL
                     logger.info("set launcher state to NEEDINSTALL")
@@ -133,7 +2051,17 @@ class Launcher:
                 "proton_media_use_gst": "0",
                 "proton_enable_wayland": "0",
                 "proton_no_d3d12": "0",
-                "mangohud": "0"
+                "mangohud": "0",
+                "download_jobs": str(DEFAULT_DOWNLOAD_JOBS),
+                "download_segments": str(DEFAULT_DOWNLOAD_SEGMENTS),
+                "hash_jobs": str(DEFAULT_HASH_JOBS),
+                "http_pool_size": str(DEFAULT_HTTP_POOL_SIZE),
+                "bandwidth_limit": "0",
+                "mirror_url": "",
+                "content_store": "",
+                "content_store_max_size": "0",
+                "metrics_textfile": "",
+                "log_levels": {}
             }
 
             if self.get_latest_proton():
@@ -146,13 +2074,48 @@ class Launcher:
         with open(settings_file_path, 'r', encoding='utf-8') as f:
             settings = json.load(f)
             self.settings = settings
+        
+        try:
+            self.download_jobs = max(1, int(self.settings.get('download_jobs', DEFAULT_DOWNLOAD_JOBS)))
+        except ValueError:
+            self.download_jobs = DEFAULT_DOWNLOAD_JOBS
+        try:
+            self.download_segments = max(1, int(self.settings.get('download_segments', DEFAULT_DOWNLOAD_SEGMENTS)))
+        except ValueError:
+            self.download_segments = DEFAULT_DOWNLOAD_SEGMENTS
+        try:
+            self.hash_jobs = max(1, int(self.settings.get('hash_jobs', DEFAULT_HASH_JOBS)))
+        except ValueError:
+            self.hash_jobs = DEFAULT_HASH_JOBS
+        try:
+            self.http_pool.pool_size = max(1, int(self.settings.get('http_pool_size', DEFAULT_HTTP_POOL_SIZE)))
+        except ValueError:
+            self.http_pool.pool_size = DEFAULT_HTTP_POOL_SIZE
+        try:
+            self.http_pool.limiter.set_rate(parse_rate(self.settings.get('bandwidth_limit', 0)))
+        except ValueError:
+            self.http_pool.limiter.set_rate(0)
+        if self.settings.get('metrics_textfile'):
+            self.metrics_textfile_path = Path(base_dir) / self.settings['metrics_textfile']
+        if self.settings.get('content_store'):
+            try:
+                self.set_content_store(self.settings['content_store'], parse_size(self.settings.get('content_store_max_size', 0)))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Content store is disabled: {e}")
+        if isinstance(self.settings.get('log_levels'), dict):
+            # levels already given on the command line win over the settings file
+            set_log_levels({
+                phase: level for phase, level in self.settings['log_levels'].items()
+                if (logger if phase == 'all' else logger.getChild(phase)).level == logging.NOTSET
+            })
             
     def init_background(self):
-        background_config = {
-            'background': 'background.webp',
-            'slogan': 'slogan.png'
-        }
-        self.background_config = background_config
+        try:
+            self.load_background()
+        finally:
+            self.background_ready.set()
+    
+    def load_background(self):
         launcher_download_info = self.get_result(WW_LAUNCHER_DOWNLOAD_API)
         if launcher_download_info is None: return
         if launcher_download_info.get('functionCode', None) is None: return
@@ -166,191 +2129,606 @@ class Launcher:
         background_file_name = background_info['firstFrameImage'].split('/')[-1]
         slogan_file_name = background_info['slogan'].split('/')[-1]
 
-        bd_download = self.download_file_with_resume(background_info['firstFrameImage'], Path(base_dir) / Path('resource') / Path(background_file_name))
-        sg_download = self.download_file_with_resume(background_info['slogan'], Path(base_dir) / Path('resource') / Path(slogan_file_name))
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            bd_future = executor.submit(self.download_file_with_resume, background_info['firstFrameImage'], Path(base_dir) / Path('resource') / Path(background_file_name))
+            sg_future = executor.submit(self.download_file_with_resume, background_info['slogan'], Path(base_dir) / Path('resource') / Path(slogan_file_name))
+            try:
+                bd_download = bd_future.result()
+                sg_download = sg_future.result()
+            except UnexpectedStatusError as e:
+                logger.error(f"Failed to download background: {e}")
+                return
         
         if bd_download and sg_download:
-            self.background_config['background'] = background_file_name
-            self.background_config['slogan'] = slogan_file_name
+            self.background_config = {
+                'background': background_file_name,
+                'slogan': slogan_file_name
+            }
         
         
     def get_gamefile_index(self):
         if self.launcher_info is None: return None
         
         indexfile_uri = self.launcher_info['default']['config']['indexFile']
-        indexfile = self.get_result(urljoin(self.cdn_node, indexfile_uri))
+        indexfile = self.get_manifest(urljoin(self.cdn_node, indexfile_uri))
         
         if not indexfile: return None
         
         return indexfile
+    
+    def fetch_cached(self, url, parse, load_cached):
+        # a conditional request against the manifest cache, parse(url, rsp) handles a fresh 200 response
+        cached_meta = self.manifest_cache.load_meta(url)
+        try:
+            headers = {
+                'User-Agent': 'Mozilla/5.0',
+                'Accept-Encoding': 'gzip'
+            }
+            if cached_meta and cached_meta.get('etag'):
+                headers['If-None-Match'] = cached_meta['etag']
+            if cached_meta and cached_meta.get('last_modified'):
+                headers['If-Modified-Since'] = cached_meta['last_modified']
+            with self.http_pool.request(url, headers=headers, timeout=10) as rsp:
+                if rsp.status == 304 and cached_meta:
+                    logger.info(f"Not modified, using cached copy of {url}")
+                    return load_cached(url)
+                if rsp.status != 200:
+                    logger.error(f"HTTP status {rsp.status} for {url}")
+                    # a server error is treated like being offline, other statuses mean the url is wrong
+                    if rsp.status >= 500 and cached_meta:
+                        logger.warning(f"Using cached copy of {url}")
+                        return load_cached(url)
+                    return None
+                return parse(url, rsp)
+        except Exception as e:
+            logger.error(f"Error fetching {url}: {str(e)}")
+            if cached_meta:
+                logger.warning(f"Using cached copy of {url}")
+                return load_cached(url)
+            return None
+    
+    @measured('manifest_fetch')
+    def get_manifest(self, url):
+        return self.fetch_cached(url, self.parse_manifest, self.get_cached_manifest)
+    
+    def parse_manifest(self, url, rsp):
+        # decompress and parse while the body streams in, copying it into the cache
+        stream = rsp
+        if 'gzip' in rsp.headers.get('Content-Encoding', '').lower():
+            stream = gzip.GzipFile(fileobj=rsp)
+        etag = rsp.headers.get('ETag')
+        last_modified = rsp.headers.get('Last-Modified')
+        writer = self.manifest_cache.writer(url, etag=etag, last_modified=last_modified) if etag or last_modified else None
+        try:
+            manifest = GameManifest.load(TeeStream(stream, writer))
+        except Exception:
+            if writer:
+                writer.abort()
+            raise
+        if writer:
+            writer.commit()
+        return manifest
+    
+    def get_cached_manifest(self, url):
+        try:
+            with self.manifest_cache.open(url) as file:
+                return GameManifest.load(file)
+        except Exception as e:
+            logger.warning(f"Failed to read cached manifest for {url}: {e}")
+            return None
         
+    @measured('download_game')
     def download_game(self):
         logger.info('Start downloading game client files...')
         self.state = LauncherState.DOWNLOADING
-        resource_list = list(self.gamefile_index['resource'])
-        self.download_game_progress.total_count = len(resource_list)
-        for resource in resource_list:
-            self.download_game_progress.total_size += resource['size']
+        # largest files first so the last running jobs are small ones
+        resource_list = self.gamefile_index.largest_first()
+        self.download_game_progress.reset(total_size=self.gamefile_index.total_size, total_count=len(resource_list))
         length = self.download_game_progress.total_count
-        logger.info(f'Total resource files: {length}')
-        for file in resource_list:
-            download_url = urljoin(self.cdn_node, self.resources_base_path + "/" + file['dest'])
+        download_logger.info(f'Total resource files: {length}, download jobs: {self.download_jobs}')
+        remaining_size = self.get_remaining_size(resource_list)
+        self.check_disk_space(DiskSpacePlan(download_size=remaining_size, growth_size=remaining_size))
+        return self.download_resources(resource_list, flag='download')
+    
+    def download_resources(self, resource_list, flag, overwrite=False, base_path=None, target_folder=None):
+        failed_files = []
+        start_time = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.download_jobs) as executor:
+            futures = {
+                executor.submit(self.download_resource, file, flag, overwrite, base_path, target_folder): file
+                for file in resource_list
+            }
+            for future in as_completed(futures):
+                file = futures[future]
+                try:
+                    ok = future.result()
+                except Exception as e:
+                    download_logger.error(f"Download {file.dest} failed: {e}")
+                    ok = False
+                if not ok:
+                    failed_files.append(file.dest)
+        self.hash_cache.save()
+        if self.content_store:
+            self.content_store.evict()
+        elapsed = time.monotonic() - start_time
+        download_logger.info(f"Processed {len(resource_list)} files "
+                             f"({format_size(sum(file.size for file in resource_list))}) in {elapsed:.1f}s")
+        if failed_files:
+            download_logger.error(f"{len(failed_files)} files could not be downloaded:")
+            for dest in sorted(failed_files):
+                download_logger.error(f"  {dest}")
+        return failed_files
+    
+    def download_resource(self, file, flag, overwrite=False, base_path=None, target_folder=None):
+        file_size = file.size
+        base_path = base_path or self.resources_base_path
+        target_folder = target_folder or self.game_folder_path
+        file_path = target_folder.joinpath(Path(file.dest))
+        # only game files are tracked by the hash cache
+        dest = file.dest if target_folder == self.game_folder_path else None
+        progress = self.get_progress(flag)
+        download_logger.debug(f"Downloading file {progress.finished_count + 1} / {progress.total_count}: {file_path}")
+        
+        start_time = time.perf_counter()
+        ok = self.fetch_resource(file, file_path, flag, overwrite, base_path, dest)
+        self.metrics.observe('download_file_seconds', time.perf_counter() - start_time, flag=flag)
+        self.metrics.observe('download_file_size_bytes', file_size, buckets=METRICS_BYTES_BUCKETS, flag=flag)
+        if not ok:
+            self.metrics.inc('download_failures_total', flag=flag)
+        progress.advance(count=1)
+        return ok
+    
+    def fetch_resource(self, file, file_path, flag, overwrite, base_path, dest):
+        file_size = file.size
+        # identical bytes from another version or install are linked instead of downloaded
+        if dest and self.content_store and (overwrite or not file_path.exists()):
+            if self.content_store.materialize(file.md5, file_size, file_path, self.get_file_md5):
+                download_logger.debug(f"{file.dest} linked from the content store")
+                self.metrics.inc('content_store_hits_total')
+                self.hash_cache.record(dest, file_path, file.md5)
+                self.update_progress(flag=flag, value=file_size)
+                return True
+        
+        ok = False
+        # the mirror only holds the current game files, a miss or md5 mismatch falls back to the cdn
+        if self.mirror_url and base_path == self.resources_base_path and not self.cdn_breaker.is_open(self.mirror_url):
+            mirror_url = quote(urljoin(self.mirror_url, base_path + "/" + file.dest), safe=':/')
+            # only a mirror that cannot be reached is taken out of rotation, a file it does not serve is a plain miss
+            try:
+                ok = self.download_from_node(self.mirror_url, mirror_url, file_path, overwrite, flag, file, dest, md5_retries=0)
+                if ok:
+                    self.cdn_breaker.record_success(self.mirror_url)
+                else:
+                    self.cdn_breaker.record_failure(self.mirror_url)
+            except UnexpectedStatusError as e:
+                (download_logger.debug if e.status == 404 else download_logger.warning)(f"Mirror: {e} for {file.dest}")
+            except ChecksumMismatchError:
+                pass
+            if not ok:
+                download_logger.info(f"{file.dest} not available from the mirror, using the CDN")
+                overwrite = False
+        
+        for attempt in range(0 if ok else DOWNLOAD_RETRIES + 1):
+            cdn_node = self.next_cdn_node()
+            download_url = urljoin(cdn_node, base_path + "/" + file.dest)
             download_url = quote(download_url, safe=':/')
-            file_size = int(file['size'])
-            file_path = self.game_folder_path.joinpath(Path(file['dest']))
-            downloaded_count = self.download_game_progress.finished_count
-            logger.info(f"Downloading file {downloaded_count + 1} / {length}: {file_path}")
-            self.download_file_with_resume(url=download_url, file_path=file_path, flag='download', file_size=file_size)
-            self.download_game_progress.finished_count += 1
+            try:
+                ok = self.download_from_node(cdn_node, download_url, file_path, overwrite, flag, file, dest)
+            except ChecksumMismatchError:
+                # the node delivered the whole file, its md5 retries are done and another round would fetch it again
+                download_logger.error(f"{file.dest} keeps failing the md5 check, giving up")
+                break
+            except UnexpectedStatusError as e:
+                logger.error(f"{e} for {download_url}")
+                ok = False
+            if ok:
+                self.cdn_breaker.record_success(cdn_node)
+                break
+            self.cdn_breaker.record_failure(cdn_node)
+            # a deleted file must not be deleted again, the retry resumes from its .temp
+            overwrite = False
+            if attempt < DOWNLOAD_RETRIES:
+                self.metrics.inc('download_retries_total', node=cdn_node)
+                delay = random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt))
+                download_logger.warning(f"Retry {file.dest} in {delay:.1f}s ({attempt + 1}/{DOWNLOAD_RETRIES})")
+                time.sleep(delay)
+        
+        # only files whose md5 was checked on the way in are shared
+        if ok and dest and self.content_store and self.hash_cache.lookup(dest, file_path) == file.md5:
+            self.content_store.add(file.md5, file_path)
+        return ok
+    
+    def download_from_node(self, node_url, url, file_path, overwrite, flag, file, dest, md5_retries=MD5_MISMATCH_RETRIES):
+        # files already on disk count as no traffic, the rest feed the per-node throughput
+        existed = not overwrite and file_path.exists()
+        start_time = time.perf_counter()
+        ok = self.download_file_with_resume(url=url, file_path=file_path, overwrite=overwrite, flag=flag,
+                                            file_size=file.size, md5=file.md5, dest=dest, md5_retries=md5_retries)
+        if ok and not existed:
+            self.metrics.inc('download_node_bytes_total', file.size, node=node_url)
+            self.metrics.inc('download_node_seconds_total', time.perf_counter() - start_time, node=node_url)
+        return ok
     
+    @measured('update_game')
     def update_game(self):
         logger.info('Starting update game client files...')
+        if self.deep_verify:
+            logger.info('Deep verify requested, checking every file')
+            return self.reconcile_game(flag='update')
+        installed_index = self.load_manifest_snapshot(self.local_version)
+        if installed_index is None:
+            logger.info('No manifest snapshot of the installed version, checking every file')
+            return self.reconcile_game(flag='update')
+        return self.update_game_by_diff(installed_index, flag='update')
+    
+    def update_game_by_diff(self, installed_index, flag='update'):
         self.state = LauncherState.UPDATING
-        resource_list = list(self.gamefile_index['resource'])
-        self.update_game_progress.total_count = len(resource_list)
-        for resource in resource_list:
-            self.update_game_progress.total_size += resource['size']
-        length = self.update_game_progress.total_count
-        for file in resource_list:
-            file_path = self.game_folder_path.joinpath(Path(file['dest']))
-            current_md5 = self.get_file_md5(file_path)
-            updated_count = self.update_game_progress.finished_count
-            logger.info(f"Updataing file {updated_count + 1} / {length}: {file_path}")
-            if current_md5 == file['md5']:
-                self.update_progress(flag='update',value=int(file['size']))
-                self.update_game_progress.finished_count += 1
-                logger.info(f'{file_path} MD5 match')
+        
+        # only resources whose dest, size or md5 changed between the two manifests are touched
+        changed_files = []
+        for file in self.gamefile_index:
+            file_path = self.game_folder_path.joinpath(Path(file.dest))
+            try:
+                size_matches = os.path.getsize(file_path) == file.size
+            except OSError:
+                size_matches = False
+            installed_file = installed_index.get(file.dest)
+            if installed_file is None or installed_file.size != file.size or installed_file.md5 != file.md5:
+                # an earlier run that failed on other files may already have downloaded this one
+                if not size_matches or self.hash_cache.lookup(file.dest, file_path) != file.md5:
+                    changed_files.append(file)
                 continue
-            logger.warning(f'{file_path} MD5 mismatch (expected: {file["md5"]}, got: {current_md5})')
-            download_url = urljoin(self.cdn_node, self.resources_base_path + "/" + file['dest'])
-            download_url = quote(download_url, safe=':/')
-            self.download_file_with_resume(url=download_url, file_path=file_path, overwrite=True, flag='update')
-            self.update_game_progress.finished_count += 1
+            # an unchanged resource that went missing or was truncated is cheap to notice
+            if not size_matches:
+                changed_files.append(file)
+        removed_files = [file for file in installed_index if file.dest not in self.gamefile_index]
+        
+        logger.info(f'Manifest diff {self.local_version} -> {self.current_version}: '
+                    f'{len(changed_files)} changed, {len(removed_files)} removed')
+        
+        # changed files are deleted before they are downloaded again, removed files before any download
+        download_size = self.get_remaining_size(changed_files, overwrite=True)
+        freed_size = self.get_existing_size(changed_files) + self.get_existing_size(removed_files)
+        self.check_disk_space(DiskSpacePlan(download_size=download_size, growth_size=download_size - freed_size))
+        
+        for file in removed_files:
+            file_path = self.game_folder_path.joinpath(Path(file.dest))
+            if file_path.is_file():
+                logger.info(f'Removing {file_path}')
+                file_path.unlink()
+            self.hash_cache.forget(file.dest)
+        self.remove_orphan_paks(self.gamefile_index)
+        
+        progress = self.get_progress(flag)
+        progress.reset(total_size=sum(file.size for file in changed_files), total_count=len(changed_files))
+        failed_files = self.download_resources(changed_files, flag=flag, overwrite=True)
+        
+        self.hash_cache.save()
+        if failed_files:
+            logger.error(f'{len(failed_files)} files are still invalid, local version is not updated')
+            return failed_files
+        
+        self.update_localVersion()
+        return failed_files
+    
+    def manifest_snapshot_path(self, version):
+        return self.game_folder_path / f'launcherManifest-{version}.json{COMPRESSED_SUFFIX}'
+    
+    def load_manifest_snapshot(self, version):
+        if not version:
+            return None
+        snapshot_path = self.manifest_snapshot_path(version)
+        if not snapshot_path.exists():
+            return None
+        try:
+            return GameManifest.load_file(snapshot_path)
+        except Exception as e:
+            logger.warning(f'Ignoring unreadable manifest snapshot {snapshot_path}: {e}')
+            return None
     
+    def save_manifest_snapshot(self):
+        snapshot_path = self.manifest_snapshot_path(self.current_version)
+        try:
+            self.gamefile_index.save(snapshot_path, version=self.current_version)
+        except OSError as e:
+            logger.warning(f'Failed to save manifest snapshot {snapshot_path}: {e}')
+            return
+        for old_snapshot_path in self.game_folder_path.glob('launcherManifest-*.json*'):
+            if old_snapshot_path != snapshot_path:
+                old_snapshot_path.unlink()
+    
+    def get_patch_resources(self):
+        # krdiff files are applied with hpatchz, resources with fromFolder are new files used as they are
+        diff_files = []
+        copied_files = {}
+        for entry in self.gamefile_index_patch['resource']:
+            resource = ManifestResource(entry['dest'], int(entry.get('size', 0)), entry.get('md5'))
+            if 'fromFolder' in entry:
+                copied_files.setdefault(entry['fromFolder'], []).append(resource)
+            else:
+                diff_files.append(resource)
+        return diff_files, copied_files
+    
+    @measured('download_patch')
     def download_patch(self):
+        if not self.gamefile_index_patch:
+            patch_logger.error(f'No incremental patch from {self.local_version} to {self.current_version}')
+            return None
+        self.state = LauncherState.DOWNLOADING
+        diff_files, copied_files = self.get_patch_resources()
+        resource_list = diff_files + [file for files in copied_files.values() for file in files]
+        progress = self.update_game_progress_patch
+        progress.reset(total_size=sum(file.size for file in resource_list), total_count=len(resource_list))
+        patch_logger.info(f'Patch {self.local_version} -> {self.current_version}: {len(diff_files)} diff files, '
+                          f'{len(resource_list) - len(diff_files)} new files, {format_size(progress.total_size)}')
         
-        self.temp_folder_path = self.game_folder_path.parent / 'temp_folder'
-        if not self.temp_folder_path.exists():
-            self.temp_folder_path.mkdir()
-        
-        krdiff_file_path = None
-        
-        for i, file in enumerate(self.gamefile_index_patch['resource']):
-            length = len(self.game_folder_path['resource'])
-            if 'fromFolder' in file:
-                download_url = urljoin(self.cdn_node, file['fromFolder'] + "/" + file['dest'])
-                download_url = quote(download_url, safe=':/')
-                file_path = self.temp_folder_path.joinpath(Path(file['dest']))
-                logger.info(f"Downloading file {i+1}/{length}: {file_path}")
-                self.download_file_with_resume(url=download_url, file_path=file_path)
-                continue
-            
-            download_url = urljoin(self.cdn_node,  self.resources_base_path_patch + "/" + file['dest'])
-            download_url = quote(download_url, safe=':/')
-            krdiff_file_path = Path(base_dir) / Path(file['dest'])
-            logger.info(f"Downloading file {i+1}/{length}: {krdiff_file_path}")
-            self.download_file_with_resume(url=download_url, file_path=krdiff_file_path)
+        download_size = (self.get_remaining_size(diff_files, target_folder=self.patch_folder_path)
+                         + self.get_remaining_size([file for files in copied_files.values() for file in files],
+                                                   target_folder=self.temp_folder_path / 'resources'))
+        # one hpatchz output is staged at a time, diffs a failed run already applied are not run again
+        applied = self.load_applied_patches(self.patch_folder_path / PATCH_APPLIED_PATH)
+        self.check_disk_space(DiskSpacePlan(
+            download_size=download_size,
+            staging_size=download_size + self.get_patch_staging_size([file for file in diff_files if file.dest not in applied]),
+            growth_size=self.get_patch_growth_size(),
+        ))
+        
+        failed_files = self.download_resources(diff_files, flag='update_patch',
+                                               base_path=self.resources_base_path_patch, target_folder=self.patch_folder_path)
+        for from_folder, files in copied_files.items():
+            failed_files += self.download_resources(files, flag='update_patch',
+                                                    base_path=from_folder, target_folder=self.temp_folder_path / 'resources')
+        return failed_files
     
+    @measured('merge_patch')
     def merge_patch(self):
+        if not self.gamefile_index_patch:
+            return None
+        self.state = LauncherState.MERGEING
+        diff_files, _ = self.get_patch_resources()
+        # a retry after a failed diff skips the ones before it, their input files are already replaced
+        applied_path = self.patch_folder_path / PATCH_APPLIED_PATH
+        applied = self.load_applied_patches(applied_path)
+        diff_files = [file for file in diff_files if file.dest not in applied]
+        self.check_disk_space(DiskSpacePlan(
+            staging_size=self.get_patch_staging_size(diff_files),
+            growth_size=self.get_patch_growth_size(),
+        ))
         
-        if self.krdiff_file_path:
-            self.run_hpatchz(self.krdiff_file_path, self.game_folder_path, self.temp_folder_path)
-            
-            for item in self.temp_folder_path.rglob('*'):
-                relative_path = item.relative_to(self.temp_folder_path)
-                destination = self.game_folder_path / relative_path
-                
-                if destination.exists():
-                    if destination.is_file():
-                        destination.unlink()
-                    else:
-                        shutil.rmtree(str(destination))
-                
-                shutil.move(str(item), str(destination))
-                
-            shutil.rmtree(str(self.temp_folder_path))
-            self.krdiff_file_path.unlink()
+        # each diff is moved into place before the next one runs, so only one hpatchz output is staged at a time
+        output_path = self.temp_folder_path / 'patch'
+        for file in diff_files:
+            if not self.run_hpatchz(self.patch_folder_path / file.dest, self.game_folder_path, output_path):
+                return [file.dest]
+            applied[file.dest] = list(self.move_patched_files(output_path))
+            shutil.rmtree(output_path, ignore_errors=True)
+            with open(applied_path, 'w', encoding='utf-8') as f:
+                json.dump(applied, f, ensure_ascii=False)
+        touched_files = {dest for dests in applied.values() for dest in dests}
+        touched_files.update(self.move_patched_files(self.temp_folder_path / 'resources'))
+        shutil.rmtree(self.temp_folder_path, ignore_errors=True)
+        shutil.rmtree(self.patch_folder_path, ignore_errors=True)
+        patch_logger.info(f'Patch wrote {len(touched_files)} files')
+        
+        return self.verify_patched_files(touched_files)
     
-    def verify_gamefile(self):
+    def load_applied_patches(self, applied_path):
+        if not applied_path.exists():
+            return {}
+        try:
+            with open(applied_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            patch_logger.warning(f'Ignoring unreadable {applied_path}: {e}')
+            return {}
+    
+    def get_patch_staging_size(self, diff_files):
+        # diffs are applied one after another, so the largest output is all that is staged at once
+        return max((self.get_patch_output_size(self.patch_folder_path / file.dest) for file in diff_files), default=0)
+    
+    def get_patch_output_size(self, patch_path):
+        # hpatchz writes the complete new directory, not only the files a diff changes
+        tool_path = self.download_patch_tool() if patch_path.is_file() else None
+        if tool_path is not None:
+            try:
+                result = subprocess.run([str(tool_path.resolve()), '-info', str(patch_path)], capture_output=True,
+                                        text=True, errors='replace', timeout=HPATCHZ_INFO_TIMEOUT)
+                match = HPATCHZ_NEW_SIZE_PATTERN.search(result.stdout)
+                if result.returncode == 0 and match:
+                    return int(match.group(1))
+            except (OSError, subprocess.SubprocessError) as e:
+                patch_logger.warning(f'hpatchz -info failed on {patch_path}: {e}')
+        # not downloaded yet or unreadable, no diff can write more than the whole new game
+        return self.gamefile_index.total_size
+    
+    def get_patch_growth_size(self):
+        installed_index = self.load_manifest_snapshot(self.local_version)
+        if installed_index is None:
+            return self.gamefile_index.total_size - self.get_existing_size(self.gamefile_index)
+        return self.gamefile_index.total_size - installed_index.total_size
+    
+    def move_patched_files(self, output_path):
+        if not output_path.exists():
+            return
+        for root, _, files in os.walk(output_path):
+            for name in files:
+                source = Path(root) / name
+                dest = source.relative_to(output_path).as_posix()
+                destination = self.game_folder_path / dest
+                destination.parent.mkdir(parents=True, exist_ok=True)
+                with self.metrics.timer('file_move_seconds'):
+                    move_file(source, destination)
+                yield dest
+    
+    def verify_patched_files(self, touched_files):
         self.state = LauncherState.VALIDATING
-        resource_list = list(self.gamefile_index['resource'])
+        installed_index = self.load_manifest_snapshot(self.local_version)
+        
+        # only files the patch rewrote with new content are hashed, anything missing is downloaded again
+        check_files = []
+        missing_files = []
+        for file in self.gamefile_index:
+            file_path = self.game_folder_path.joinpath(Path(file.dest))
+            try:
+                size_ok = os.path.getsize(file_path) == file.size
+            except OSError:
+                size_ok = False
+            if not size_ok:
+                missing_files.append(file)
+                continue
+            if file.dest not in touched_files:
+                continue
+            installed_file = installed_index.get(file.dest) if installed_index else None
+            if installed_file is None or installed_file.size != file.size or installed_file.md5 != file.md5:
+                check_files.append(file)
+        
+        progress = self.update_game_progress_patch
+        progress.reset(total_size=sum(file.size for file in check_files), total_count=len(check_files))
+        mismatch_files = list(missing_files)
+        for file, current_md5 in self.hash_resources(check_files):
+            if current_md5 == file.md5:
+                verify_logger.debug(f'{file.dest} MD5 match')
+                self.update_progress(flag='update_patch', value=file.size)
+                progress.advance(count=1)
+                continue
+            verify_logger.warning(f'{file.dest} MD5 mismatch after patch (expected: {file.md5}, got: {current_md5})')
+            mismatch_files.append(file)
+        verify_logger.info(f'Checked {len(check_files)} patched files, {len(mismatch_files)} need to be downloaded')
+        
+        if installed_index:
+            for file in installed_index:
+                if file.dest not in self.gamefile_index:
+                    file_path = self.game_folder_path.joinpath(Path(file.dest))
+                    if file_path.is_file():
+                        patch_logger.info(f'Removing {file_path}')
+                        file_path.unlink()
+                    self.hash_cache.forget(file.dest)
+        self.remove_orphan_paks(self.gamefile_index)
+        
+        failed_files = []
+        if mismatch_files:
+            download_size = self.get_remaining_size(mismatch_files, overwrite=True)
+            self.check_disk_space(DiskSpacePlan(download_size=download_size,
+                                                growth_size=download_size - self.get_existing_size(mismatch_files)))
+            progress.reset(total_size=sum(file.size for file in mismatch_files), total_count=len(mismatch_files))
+            failed_files = self.download_resources(mismatch_files, flag='update_patch', overwrite=True)
+        
+        self.hash_cache.save()
+        if failed_files:
+            patch_logger.error(f'{len(failed_files)} files are still invalid, local version is not updated')
+        else:
+            self.update_localVersion()
+        return failed_files
+    
+    @measured('verify_gamefile')
+    def verify_gamefile(self):
+        return self.reconcile_game(flag='verify')
+    
+    def reconcile_game(self, flag='verify'):
+        self.state = LauncherState.UPDATING if flag == 'update' else LauncherState.VALIDATING
+        resource_list = self.gamefile_index
+        progress = self.get_progress(flag)
+        progress.reset(total_size=resource_list.total_size, total_count=len(resource_list))
+        
+        self.remove_orphan_paks(resource_list)
+        
+        # every file is hashed at most once, unchanged files come from the hash cache
+        mismatch_files = []
+        for file, current_md5 in self.hash_resources(resource_list):
+            file_path = self.game_folder_path.joinpath(Path(file.dest))
+            if current_md5 == file.md5:
+                verify_logger.debug(f'{file_path} MD5 match')
+                if self.content_store:
+                    self.content_store.add(file.md5, file_path)
+                self.update_progress(flag=flag, value=file.size)
+                progress.advance(count=1)
+                continue
+            verify_logger.warning(f'{file_path} MD5 mismatch (expected: {file.md5}, got: {current_md5})')
+            mismatch_files.append(file)
+        verify_logger.info(f'Checked {len(resource_list)} files, {len(mismatch_files)} mismatched')
         
-        chunk_paks = []
+        failed_files = []
+        if mismatch_files:
+            verify_logger.info(f'{len(mismatch_files)} files need to be downloaded again')
+            download_size = self.get_remaining_size(mismatch_files, overwrite=True)
+            self.check_disk_space(DiskSpacePlan(download_size=download_size,
+                                                growth_size=download_size - self.get_existing_size(mismatch_files)))
+            self.download_resources(mismatch_files, flag=flag, overwrite=True)
+            # re-downloaded files were hashed while streaming, this only reads the cache
+            for file, current_md5 in self.hash_resources(mismatch_files):
+                if current_md5 == file.md5:
+                    verify_logger.debug(f"{file.dest} MD5 OK after re-download")
+                else:
+                    verify_logger.error(f"{file.dest} Still MD5 mismatch after re-download")
+                    failed_files.append(file.dest)
+        
+        self.hash_cache.save()
+        if self.content_store:
+            self.content_store.hash_cache.save()
+        if failed_files:
+            logger.error(f'{len(failed_files)} files are still invalid, local version is not updated')
+            return failed_files
         
+        self.update_localVersion()
+        return failed_files
+    
+    def remove_orphan_paks(self, resource_list):
+        chunk_paks = set()
         for resource in resource_list:
-            self.verify_game_progress.total_size += resource['size']
-            if resource['dest'].startswith('Client/Content/Paks/'):
-                chunk_paks.append(resource['dest'].split('/')[-1])
-                
-        print(chunk_paks)
-                
+            if resource.dest.startswith('Client/Content/Paks/'):
+                chunk_paks.add(resource.dest.split('/')[-1])
+        
         # 删除无效的pak文件
-        local_chunk_paks = os.listdir(self.game_folder_path / 'Client' / 'Content' / 'Paks')
-        for chunk_pak in local_chunk_paks:
-            if chunk_pak not in chunk_paks:
-                remove_file = self.game_folder_path / 'Client' / 'Content' / 'Paks' / chunk_pak
+        paks_folder_path = self.game_folder_path / 'Client' / 'Content' / 'Paks'
+        if not paks_folder_path.exists():
+            return
+        for chunk_pak in os.listdir(paks_folder_path):
+            # keep partial downloads of paks that are still in the manifest
+            if chunk_pak.split('.temp')[0] not in chunk_paks:
+                remove_file = paks_folder_path / chunk_pak
                 logger.warning(f'Chunk pak {chunk_pak} will be removed')
-                if remove_file.exists():
+                if remove_file.is_file():
                     remove_file.unlink()
     
-        for file in resource_list:
-            file_path = self.game_folder_path.joinpath(Path(file['dest']))
-            
-            current_md5 = self.get_file_md5(file_path)
-
-            if current_md5 == file['md5']:
-                logger.info(f'{file_path} MD5 match')
-                self.update_progress(flag='verify',value=int(file['size']))
-                continue
-            
-            logger.warning(f'{file_path} MD5 mismatch (expected: {file["md5"]}, got: {current_md5})')
-            download_url = urljoin(self.cdn_node, self.resources_base_path + "/" + file['dest'])
-            download_url = quote(download_url, safe=':/')
-            self.download_file_with_resume(url=download_url, file_path=file_path, overwrite=True)
-            
-            current_md5 = self.get_file_md5(file_path)
-            if current_md5 == file['md5']:
-                logger.info(f'{file_path} MD5 OK after re-download')
-            else:
-                logger.error(f'{file_path} Still MD5 mismatch after re-download')
-            self.update_progress(flag='verify',value=int(file['size']))
-            
-        self.update_localVersion()
-    
+    @measured('manifest_fetch')
     def get_result(self, url):
-        try:
-            req = Request(url, headers={
-                'User-Agent': 'Mozilla/5.0',
-                'Accept-Encoding': 'gzip'
-            })
-            with urlopen(req, timeout=10) as rsp:
-                if rsp.status != 200:
-                    logger.error(f"HTTP status {rsp.status} for {url}")
-                    return None
-                content_encoding = rsp.headers.get('Content-Encoding', '').lower()
-                data = rsp.read()
-                if 'gzip' in content_encoding:
-                    try:
-                        with gzip.GzipFile(fileobj=io.BytesIO(data)) as f:
-                            data = f.read()
-                    except Exception as e:
-                        logger.error(f"Gzip decompression error: {str(e)}")
-                        return None
-                try:
-                    return json.loads(data.decode('utf-8'))
-                except UnicodeDecodeError:
-                    try:
-                        return json.loads(data.decode('gbk'))
-                    except:
-                        logger.error("Failed to decode JSON response")
-                        return None        
-        except HTTPError as e:
-            logger.error(f"HTTP Error {e.code}: {e.reason}")
+        return self.fetch_cached(url, self.parse_result, self.get_cached_result)
+    
+    def parse_result(self, url, rsp):
+        content_encoding = rsp.headers.get('Content-Encoding', '').lower()
+        data = rsp.read()
+        if 'gzip' in content_encoding:
+            try:
+                with gzip.GzipFile(fileobj=io.BytesIO(data)) as f:
+                    data = f.read()
+            except Exception as e:
+                logger.error(f"Gzip decompression error: {str(e)}")
+                return None
+        result = self.decode_json(data)
+        if result is not None and (rsp.headers.get('ETag') or rsp.headers.get('Last-Modified')):
+            self.manifest_cache.store(url, data, etag=rsp.headers.get('ETag'), last_modified=rsp.headers.get('Last-Modified'))
+        return result
+    
+    def get_cached_result(self, url):
+        data = self.manifest_cache.load(url)
+        if data is None:
             return None
-        except Exception as e:
-            logger.error(f"Error fetching patch info: {str(e)}")
+        return self.decode_json(data)
+    
+    def decode_json(self, data):
+        try:
+            return json.loads(data.decode('utf-8'))
+        except UnicodeDecodeError:
+            try:
+                return json.loads(data.decode('gbk'))
+            except:
+                logger.error("Failed to decode JSON response")
+                return None
+        except ValueError:
+            logger.error("Failed to decode JSON response")
             return None
     
+    @measured('select_cdn')
     def select_cdn(self):
         if self.launcher_info is None: return None
         
@@ -358,6 +2736,47 @@ class Launcher:
         
         if not cdnlist: return None
         
+        available_nodes = [node for node in cdnlist if node['K1'] == 1 and node['K2'] == 1]
+        if not available_nodes:
+            return None
+        
+        # measure every node at once, a small ranged GET of the manifest is enough
+        probe_uri = self.launcher_info['default']['config']['indexFile']
+        with ThreadPoolExecutor(max_workers=len(available_nodes)) as executor:
+            list(executor.map(lambda node: self.probe_cdn_node(node['url'], probe_uri), available_nodes))
+        self.cdn_stats.save()
+        
+        def rank(node):
+            throughput = self.cdn_stats.throughput(node['url'])
+            latency = self.cdn_stats.latency(node['url'])
+            if not throughput:
+                return (1, -node['P'], 0)
+            return (0, -throughput, latency or 0)
+        ranked_nodes = sorted(available_nodes, key=rank)
+        self.cdn_fallback_nodes = [node['url'] for node in ranked_nodes]
+        
+        best_throughput = self.cdn_stats.throughput(ranked_nodes[0]['url']) or 0
+        self.cdn_nodes = [
+            node['url'] for node in ranked_nodes[:CDN_STRIPE_NODES]
+            if best_throughput == 0 or (self.cdn_stats.throughput(node['url']) or 0) >= best_throughput * CDN_STRIPE_MIN_RATIO
+        ]
+        if best_throughput == 0:
+            # nothing could be measured, keep the static priority order
+            self.cdn_nodes = [self.priority_cdn_node()]
+        
+        for node_url in self.cdn_nodes:
+            throughput = self.cdn_stats.throughput(node_url) or 0
+            latency = self.cdn_stats.latency(node_url) or 0
+            cdn_logger.info(f"CDN node {node_url}: {throughput / 1024 / 1024:.2f} MB/s, {latency * 1000:.0f} ms")
+        return self.cdn_nodes[0]
+    
+    def priority_cdn_node(self):
+        if self.launcher_info is None: return None
+        
+        cdnlist = self.launcher_info['default'].get('cdnList', None)
+        
+        if not cdnlist: return None
+        
         available_nodes = [node for node in cdnlist if node['K1'] == 1 and node['K2'] == 1]
         if not available_nodes:
             return None
@@ -368,6 +2787,167 @@ class Launcher:
             if node['P'] == max_priority:
                 return node['url']
     
+    def probe_cdn_node(self, node_url, probe_uri):
+        url = urljoin(node_url, probe_uri)
+        headers = {
+            'User-Agent': 'Mozilla/5.0',
+            'Range': f'bytes=0-{CDN_PROBE_SIZE - 1}'
+        }
+        try:
+            start_time = time.monotonic()
+            # probes measure the node, so they are not held back by the bandwidth limit
+            with self.http_pool.request(url, headers=headers, timeout=CDN_PROBE_TIMEOUT, throttle=False) as rsp:
+                latency = time.monotonic() - start_time
+                if rsp.status not in (200, 206):
+                    raise IOError(f"HTTP status {rsp.status}")
+                size = 0
+                while size < CDN_PROBE_SIZE:
+                    chunk = rsp.read(min(64 * 1024, CDN_PROBE_SIZE - size))
+                    if not chunk:
+                        break
+                    size += len(chunk)
+            # small probes are dominated by round trips, so the handshake time is included
+            elapsed = max(time.monotonic() - start_time, 1e-3)
+            self.cdn_stats.record(node_url, latency=latency, throughput=size / elapsed)
+            self.metrics.set('cdn_probe_throughput_bytes_per_second', size / elapsed, node=node_url)
+            self.metrics.set('cdn_probe_latency_seconds', latency, node=node_url)
+        except Exception as e:
+            cdn_logger.warning(f"CDN node {node_url} probe failed: {e}")
+            self.cdn_stats.record(node_url, latency=CDN_PROBE_TIMEOUT, throughput=0)
+            self.metrics.inc('cdn_probe_failures_total', node=node_url)
+    
+    def next_cdn_node(self):
+        stripe_nodes = [node_url for node_url in self.cdn_nodes if not self.cdn_breaker.is_open(node_url)]
+        if not stripe_nodes:
+            # every fast node is failing, move on to the rest of cdnList
+            fallback_nodes = [node_url for node_url in self.cdn_fallback_nodes if not self.cdn_breaker.is_open(node_url)]
+            if fallback_nodes:
+                return fallback_nodes[0]
+            if self.cdn_fallback_nodes:
+                return min(self.cdn_fallback_nodes, key=self.cdn_breaker.reopen_time)
+            return self.cdn_node
+        if len(stripe_nodes) < 2:
+            return stripe_nodes[0]
+        # smooth weighted round robin, faster nodes get proportionally more files
+        with self.cdn_lock:
+            total = 0
+            best_node = None
+            for node_url in stripe_nodes:
+                weight = max(self.cdn_stats.throughput(node_url) or 0, 1)
+                self.cdn_weights[node_url] = self.cdn_weights.get(node_url, 0) + weight
+                total += weight
+                if best_node is None or self.cdn_weights[node_url] > self.cdn_weights[best_node]:
+                    best_node = node_url
+            self.cdn_weights[best_node] -= total
+            return best_node
+    
+    def refresh(self):
+        # fetches the launcher api and the manifest again, both are revalidated against manifestCache
+        launcher_info = self.get_result(self.launcher_api)
+        if launcher_info is None:
+            logger.warning("Launcher api is not reachable, keeping the current state")
+            return False
+        self.launcher_info = launcher_info
+        self.resources_base_path = launcher_info['default']['resourcesBasePath']
+        self.current_version = launcher_info['default']['version']
+        self.local_version = self.get_localVersion()
+        gamefile_index = self.get_gamefile_index()
+        if gamefile_index is None:
+            logger.warning("Game file list is not reachable, keeping the current state")
+            return False
+        self.gamefile_index = gamefile_index
+        self.support_incremental_patching = False
+        self.target_patch = None
+        self.gamefile_index_patch = None
+        self.resources_base_path_patch = None
+        self.init_incremental_update()
+        self.init_launcher_state()
+        return True
+    
+    def serve_daemon(self, address):
+        if self.state == LauncherState.NETWORKERROR:
+            logger.error("Launcher could not be initialized, not starting the daemon")
+            return False
+        daemon = LauncherDaemon(self)
+        if address.startswith('unix:'):
+            socket_path = address[len('unix:'):]
+            if os.path.exists(socket_path):
+                os.unlink(socket_path)
+            server = DaemonUnixHTTPServer(socket_path, daemon)
+        else:
+            host, _, port = address.rpartition(':')
+            server = DaemonHTTPServer((host or '127.0.0.1', int(port)), daemon)
+        logger.info(f"Daemon listening on {address}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.set_progress_callback(None)
+            if address.startswith('unix:'):
+                Path(address[len('unix:'):]).unlink(missing_ok=True)
+        return True
+    
+    def set_content_store(self, store_path, max_size=0):
+        if not store_path:
+            self.content_store = None
+            return None
+        self.content_store = ContentStore(Path(base_dir) / store_path, max_size)
+        logger.info(f"Content store: {self.content_store.store_path}")
+        return self.content_store
+    
+    def set_mirror(self, mirror_url):
+        self.mirror_url = None
+        self.mirror_url = self.probe_mirror(mirror_url)
+        return self.mirror_url
+    
+    def probe_mirror(self, mirror_url):
+        # the normalized url when the mirror serves the current version, None otherwise
+        if not mirror_url:
+            return None
+        mirror_url = mirror_url if mirror_url.endswith('/') else mirror_url + '/'
+        try:
+            with self.http_pool.request(urljoin(mirror_url, MIRROR_INFO_PATH), headers={'User-Agent': 'Mozilla/5.0'},
+                                        timeout=CDN_PROBE_TIMEOUT, throttle=False) as rsp:
+                if rsp.status != 200:
+                    raise IOError(f"HTTP status {rsp.status}")
+                info = json.loads(rsp.read())
+        except Exception as e:
+            cdn_logger.warning(f"Mirror {mirror_url} is not reachable: {e}")
+            return None
+        if info.get('version') != self.current_version or info.get('resourcesBasePath') != self.resources_base_path:
+            cdn_logger.warning(f"Mirror {mirror_url} serves version {info.get('version')}, "
+                               f"not {self.current_version}, ignoring it")
+            return None
+        cdn_logger.info(f"Using mirror {mirror_url}")
+        return mirror_url
+    
+    def serve_mirror(self, address):
+        if self.gamefile_index is None:
+            mirror_logger.error("Game file list is not available, cannot serve a mirror")
+            return False
+        if self.local_version != self.current_version:
+            mirror_logger.error(f"Installed version {self.local_version} is not the current version "
+                                f"{self.current_version}, update the game before serving it")
+            return False
+        # only a verified folder is served, the hash cache keeps this quick after the first run
+        if self.verify_gamefile():
+            mirror_logger.error("Game files could not be verified, not serving them")
+            return False
+        host, _, port = address.rpartition(':')
+        server = MirrorServer((host, int(port or DEFAULT_MIRROR_PORT)), self.game_folder_path,
+                              self.resources_base_path, self.gamefile_index, self.current_version)
+        mirror_logger.info(f"Serving {self.game_folder_path} ({self.current_version}) on "
+                           f"http://{host or '0.0.0.0'}:{server.server_address[1]}/")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return True
+    
     def get_localVersion(self):
         file_path = self.game_folder_path / "launcherDownloadConfig.json"
         if not os.path.exists(file_path):
@@ -388,71 +2968,368 @@ class Launcher:
         file_path = self.game_folder_path / "launcherDownloadConfig.json"
         with open(file_path, 'w', encoding='utf-8') as file:
             json.dump(temp, file, ensure_ascii=False)
+        self.save_manifest_snapshot()
+        self.local_version = new_version
+    
+    def get_remaining_size(self, resource_list, target_folder=None, overwrite=False):
+        # bytes still to fetch, counting partial .temp files and, unless overwritten, finished files
+        target_folder = target_folder or self.game_folder_path
+        remaining_size = 0
+        for file in resource_list:
+            file_path = target_folder.joinpath(Path(file.dest))
+            if not overwrite and file_path.exists():
+                continue
+            try:
+                done_size = os.path.getsize(f'{file_path}.temp')
+            except OSError:
+                done_size = 0
+            remaining_size += max(0, file.size - done_size)
+        return remaining_size
+    
+    def get_existing_size(self, resource_list):
+        existing_size = 0
+        for file in resource_list:
+            try:
+                existing_size += os.path.getsize(self.game_folder_path.joinpath(Path(file.dest)))
+            except OSError:
+                pass
+        return existing_size
     
-    def download_file_with_resume(self, url, file_path, overwrite=False, flag=None, file_size=None):
+    def check_disk_space(self, plan):
+        # checked before a job starts, so a full disk fails right away instead of halfway through
+        requirements = {}
+        def require(path, size):
+            while not path.exists():
+                path = path.parent
+            device = os.stat(path).st_dev
+            requirement = requirements.setdefault(device, [path, 0])
+            requirement[1] += size
+        require(self.game_folder_path, max(0, plan.growth_size))
+        require(self.temp_folder_path.parent, plan.staging_size)
+        
+        logger.info(f'Disk space plan: download {format_size(plan.download_size)}, '
+                    f'staging {format_size(plan.staging_size)}, game folder growth {format_size(plan.growth_size)}')
+        for path, required_size in requirements.values():
+            if required_size <= 0:
+                continue
+            free_size = shutil.disk_usage(path).free
+            if free_size < required_size + DISK_SPACE_RESERVE:
+                raise InsufficientDiskSpaceError(
+                    f'Not enough disk space on {path}: {format_size(required_size + DISK_SPACE_RESERVE)} needed '
+                    f'(including {format_size(DISK_SPACE_RESERVE)} reserve), {format_size(free_size)} free')
+    
+    def download_file_with_resume(self, url, file_path, overwrite=False, flag=None, file_size=None, md5=None, dest=None,
+                                  md5_retries=MD5_MISMATCH_RETRIES):
         directory = file_path.parent
         if not directory.exists():
-            os.makedirs(directory)
+            os.makedirs(directory, exist_ok=True)
         
         if os.path.exists(file_path):
             if not overwrite:
                 if file_size:
                     self.update_progress(flag=flag, value=file_size)
-                logger.info(f'{file_path} already exists. Skipping download.')
+                download_logger.debug(f'{file_path} already exists. Skipping download.')
                 return True
             else:
                 os.remove(file_path)
-                logger.info(f'{file_path} is deleted and start re-download.')
+                download_logger.debug(f'{file_path} is deleted and start re-download.')
         
+        for attempt in range(md5_retries + 1):
+            try:
+                if file_size and file_size >= SEGMENTED_DOWNLOAD_MIN_SIZE and self.download_segments > 1:
+                    return self.download_file_segmented(url, file_path, file_size, flag=flag, md5=md5, dest=dest)
+                return self.download_file_stream(url, file_path, flag=flag, md5=md5, dest=dest, file_size=file_size)
+            except ChecksumMismatchError as e:
+                self.metrics.inc('download_md5_mismatches_total')
+                download_logger.error(f"{e} (attempt {attempt + 1}/{md5_retries + 1})")
+                if attempt == md5_retries:
+                    # the transfer itself worked, the caller must not take this for a network failure
+                    raise
+    
+    def finish_download(self, temp_file_path, file_path, digest, md5=None, dest=None):
+        if md5 and digest != md5:
+            temp_file_path.unlink()
+            raise ChecksumMismatchError(f'{file_path} MD5 mismatch after download (expected: {md5}, got: {digest})')
+        # the .temp file sits next to its target, so this is always a rename
+        os.replace(temp_file_path, file_path)
+        if dest:
+            self.hash_cache.record(dest, file_path, digest)
+    
+    def download_file_stream(self, url, file_path, flag=None, md5=None, dest=None, file_size=None):
+        directory = file_path.parent
         temp_file_path = directory / f'{file_path.name}.temp'
-        downloaded_bytes = 0
-        if os.path.exists(temp_file_path):
+        journal_path = directory / f'{file_path.name}.temp.segments'
+        
+        md5_hash = hashlib.md5()
+        # the size of a preallocated .temp says nothing about progress, a one segment journal records it
+        journal = None
+        if file_size and file_size >= PREALLOCATE_MIN_SIZE:
+            journal = self.open_journal(temp_file_path, journal_path, file_size, 1)
+            if len(journal.segments) != 1:
+                temp_file_path.unlink()
+                journal = self.open_journal(temp_file_path, journal_path, file_size, 1)
+            elif journal.done_size:
+                # the verified prefix is hashed on the way, so it is read only once
+                self.check_journal(journal, temp_file_path, file_path, split=False, md5_hash=md5_hash)
+            downloaded_bytes = journal.done_size
+        elif os.path.exists(temp_file_path):
             downloaded_bytes = os.path.getsize(temp_file_path)
+        else:
+            downloaded_bytes = 0
             
         headers = {'User-Agent': 'Mozilla/5.0'}
         if downloaded_bytes > 0:
             headers['Range'] = f'bytes={downloaded_bytes}-'
+            if journal and journal.validator:
+                headers['If-Range'] = journal.validator
             
-        content_length = 0
-        
-        try:
-            req = Request(url, headers=headers)
-            with urlopen(req, timeout=10) as rsp:
-                if rsp.status == 206:
-                    content_length = int(rsp.headers.get('Content-Length'))
-                    total_size = downloaded_bytes + content_length
-                elif rsp.status == 200:
-                    content_length = int(rsp.headers.get('Content-Length'))
-                    total_size = content_length if content_length else 0
-                    if downloaded_bytes > 0:
-                        logger.warning("Server doesn't support resume, restarting download")
-                        downloaded_bytes = 0
-                else:
-                    logger.error(f"Unexpected HTTP status: {rsp.status}")
-                    return False
-                
-                mode = "ab" if downloaded_bytes > 0 else "wb"
-                with open(temp_file_path, mode) as file:
-                    while True:
-                        chunk = rsp.read(1024 * 1024)
-                        if not chunk:
-                            break
-                        file.write(chunk)
-                        downloaded_bytes += len(chunk)
-                        self.update_progress(flag=flag, value=len(chunk))
-                        if total_size > 0:
-                            percent = (downloaded_bytes / total_size) * 100
-                            logger.info(f"{file_path} size:{total_size/1024/1024:.1f} MB {percent:.1f}%")
+        received_bytes = 0
+        
+        try:
+            if journal and downloaded_bytes == file_size:
+                # a previous run wrote everything but did not get to the md5 check
+                pass
+            else:
+                with self.http_pool.request(url, headers=headers, timeout=10) as rsp:
+                    if rsp.status == 416 and downloaded_bytes > 0 and not journal:
+                        # the .temp file already holds the whole file
+                        self.update_file_md5(md5_hash, temp_file_path)
+                    elif rsp.status in (200, 206):
+                        if rsp.status == 206 and not journal:
+                            # the resumed prefix is already on disk, hash it before appending
+                            self.update_file_md5(md5_hash, temp_file_path)
+                        elif rsp.status == 200 and downloaded_bytes > 0:
+                            if journal and journal.validator:
+                                download_logger.warning(f"{file_path} changed on the server, restarting download")
+                            else:
+                                download_logger.warning("Server doesn't support resume, restarting download")
+                            downloaded_bytes = 0
+                            md5_hash = hashlib.md5()
+                            if journal:
+                                journal.reset()
+                        if journal and journal.validator is None:
+                            journal.validator = response_validator(rsp)
+                            journal.save()
+                        received_bytes = self.write_stream(rsp, temp_file_path, downloaded_bytes, md5_hash, flag, file_size, journal)
+                    else:
+                        raise UnexpectedStatusError(rsp.status)
             
-            shutil.move(temp_file_path, file_path)
+            if journal:
+                self.close_journal(journal_path)
+            try:
+                self.finish_download(temp_file_path, file_path, md5_hash.hexdigest(), md5=md5, dest=dest)
+            except ChecksumMismatchError:
+                self.update_progress(flag=flag, value=-received_bytes)
+                raise
             return True
+        except (ChecksumMismatchError, UnexpectedStatusError):
+            raise
+        except Exception as e:
+            download_logger.error(f"Download error: {str(e)}")
+            return False
+    
+    def write_stream(self, rsp, temp_file_path, position, md5_hash, flag, file_size, journal=None):
+        # reads go straight into the writer's buffers while the previous ones are hashed and written
+        mode = 'r+b' if journal or position > 0 else 'wb'
+        received_bytes = 0
+        with open(temp_file_path, mode, buffering=0) as file:
+            # small files get a small pool, they are done after a read or two
+            writer = FileWriter(file, md5_hash=md5_hash, on_written=journal.record if journal else None,
+                                buffer_size=min(WRITE_BUFFER_SIZE, file_size or WRITE_BUFFER_SIZE) or 1,
+                                buffer_count=WRITE_BUFFER_COUNT if journal else 2)
+            completed = False
+            try:
+                while True:
+                    buffer = writer.get_buffer()
+                    try:
+                        size = rsp.readinto(buffer)
+                    except BaseException:
+                        writer.release_buffer(buffer)
+                        raise
+                    if not size:
+                        writer.release_buffer(buffer)
+                        break
+                    writer.write(buffer, size, position, journal.segments[0] if journal else None)
+                    position += size
+                    received_bytes += size
+                    self.update_progress(flag=flag, value=size)
+                # http.client's readinto ends quietly on a connection closed early, that is a network failure
+                # to resume from, not a finished file for the md5 check to reject
+                if file_size and position < file_size:
+                    raise IOError(f"Connection closed at {position} of {file_size}")
+                completed = True
+            finally:
+                writer.close(sync=completed)
+                if journal:
+                    journal.save()
+        return received_bytes
+    
+    def open_journal(self, temp_file_path, journal_path, file_size, segment_count):
+        temp_file_ok = temp_file_path.exists() and os.path.getsize(temp_file_path) == file_size
+        journal = self.open_journals.get(journal_path)
+        if journal is not None and journal.size == file_size and journal_path.exists() and temp_file_ok:
+            return journal
+        journal = DownloadJournal.load(journal_path, file_size)
+        if journal is not None and temp_file_ok:
+            # left by an earlier run, check_journal reads it back once
+            self.open_journals[journal_path] = journal
+            return journal
+        
+        # a .temp without a journal was left by a download that only appended, its size is the progress
+        done = 0
+        if journal is None and temp_file_path.exists() and not journal_path.exists() and segment_count == 1:
+            done = min(os.path.getsize(temp_file_path), file_size)
+        journal = DownloadJournal.create(journal_path, file_size, segment_count, done)
+        if done:
+            # its full blocks are taken as they are, the md5 of the finished file has the last word
+            done = done // JOURNAL_BLOCK_SIZE * JOURNAL_BLOCK_SIZE
+            journal.segments[0]['done'] = done
+            with open(temp_file_path, 'rb', buffering=0) as file:
+                for block in range(done // JOURNAL_BLOCK_SIZE):
+                    journal.blocks[block] = zlib.crc32(file.read(JOURNAL_BLOCK_SIZE))
+        # the journal is written first, a crash before preallocation then leaves a .temp of the wrong size
+        journal.save()
+        with open(temp_file_path, 'r+b' if done else 'wb') as file:
+            preallocate_file(file, file_size)
+        self.open_journals[journal_path] = journal
+        return journal
+    
+    def close_journal(self, journal_path):
+        self.open_journals.pop(journal_path, None)
+        if journal_path.exists():
+            journal_path.unlink()
+    
+    def check_journal(self, journal, temp_file_path, file_path, split=True, md5_hash=None):
+        if journal.verified:
+            # every block was written by this process, only the md5 of a single stream needs the prefix
+            if md5_hash:
+                self.update_file_md5(md5_hash, temp_file_path, size=journal.done_size)
+            return
+        journal.verified = True
+        done_size = journal.done_size
+        corrupt_blocks = journal.verify(temp_file_path, split=split, md5_hash=md5_hash, wait=self.wait_if_paused)
+        if corrupt_blocks:
+            download_logger.warning(f'{file_path}: {len(corrupt_blocks)} damaged blocks in the partial download, '
+                                    f'fetching {format_size(done_size - journal.done_size)} again')
+        if journal.done_size != done_size:
+            journal.save()
+    
+    def download_file_segmented(self, url, file_path, file_size, flag=None, md5=None, dest=None):
+        directory = file_path.parent
+        temp_file_path = directory / f'{file_path.name}.temp'
+        journal_path = directory / f'{file_path.name}.temp.segments'
+        
+        journal = self.open_journal(temp_file_path, journal_path, file_size, self.download_segments)
+        if journal.done_size:
+            self.check_journal(journal, temp_file_path, file_path)
+        
+        downloaded_bytes = journal.done_size
+        if downloaded_bytes:
+            download_logger.debug(f'{file_path} resume segmented download from {downloaded_bytes / 1024 / 1024:.1f} MB')
+        
+        pending = journal.pending_segments()
+        
+        # the first range request tells whether the server honours Range at all, and with
+        # If-Range whether the file is still the one the journal was written for
+        try:
+            rsp = self.open_segment(url, pending[0], journal.validator) if pending else None
         except Exception as e:
-            logger.error(f"Download error: {str(e)}")
-            if e.code == 416 and downloaded_bytes == content_length:
-                if temp_file_path.exists(): 
-                    shutil.move(temp_file_path, file_path)
+            download_logger.error(f"Download error: {str(e)}")
+            return False
+        if rsp is not None and rsp.status not in (200, 206):
+            rsp.close()
+            raise UnexpectedStatusError(rsp.status)
+        if rsp is not None and rsp.status == 200:
+            rsp.close()
+            if journal.validator and downloaded_bytes:
+                download_logger.warning(f"{file_path} changed on the server, restarting download")
+                temp_file_path.unlink()
+                self.close_journal(journal_path)
+                return self.download_file_segmented(url, file_path, file_size, flag=flag, md5=md5, dest=dest)
+            download_logger.warning(f"Server doesn't support range requests, fallback to single stream: {file_path}")
+            temp_file_path.unlink()
+            self.close_journal(journal_path)
+            return self.download_file_stream(url, file_path, flag=flag, md5=md5, dest=dest, file_size=file_size)
+        if rsp is not None and journal.validator is None:
+            journal.validator = response_validator(rsp)
+            journal.save()
+        
+        ok = True
+        if pending:
+            download_logger.debug(f'{file_path} downloading in {len(pending)} segments')
+            with open(temp_file_path, 'r+b', buffering=0) as file:
+                writer = FileWriter(file, on_written=journal.record)
+                try:
+                    # repaired blocks may add segments, the connections stay capped
+                    with ThreadPoolExecutor(max_workers=min(len(pending), max(self.download_segments, 1))) as executor:
+                        futures = [executor.submit(self.download_segment, url, writer, segment, flag,
+                                                   rsp if i == 0 else None, journal.validator)
+                                   for i, segment in enumerate(pending)]
+                        for future in futures:
+                            try:
+                                future.result()
+                            except Exception as e:
+                                download_logger.error(f"Segment download error: {str(e)}")
+                                ok = False
+                finally:
+                    try:
+                        writer.close(sync=ok)
+                    except Exception as e:
+                        download_logger.error(f"Write error: {str(e)}")
+                        ok = False
+            journal.save()
+        
+        if not ok:
             return False
+        
+        # ranges arrive out of order, so the file is hashed once it is complete
+        md5_hash = hashlib.md5()
+        self.update_file_md5(md5_hash, temp_file_path)
+        self.close_journal(journal_path)
+        try:
+            self.finish_download(temp_file_path, file_path, md5_hash.hexdigest(), md5=md5, dest=dest)
+        except ChecksumMismatchError:
+            self.update_progress(flag=flag, value=downloaded_bytes - file_size)
+            raise
+        return True
+    
+    def open_segment(self, url, segment, validator=None):
+        start = segment['start'] + segment['done']
+        headers = {
+            'User-Agent': 'Mozilla/5.0',
+            'Range': f"bytes={start}-{segment['end']}"
+        }
+        if validator:
+            headers['If-Range'] = validator
+        return self.http_pool.request(url, headers=headers, timeout=10)
+    
+    def download_segment(self, url, writer, segment, flag, rsp=None, validator=None):
+        if rsp is None:
+            rsp = self.open_segment(url, segment, validator)
+        with rsp:
+            # segment['done'] only moves on the writer thread, the read position is tracked here
+            position = segment['start'] + segment['done']
+            end = segment['end'] + 1
+            if rsp.status != 206:
+                raise IOError(f"Unexpected HTTP status {rsp.status} for range {position}-{segment['end']}")
+            content_range = rsp.headers.get('Content-Range', '')
+            if not content_range.startswith(f'bytes {position}-'):
+                raise IOError(f"Unexpected Content-Range '{content_range}' for range {position}-{segment['end']}")
             
+            while position < end:
+                buffer = writer.get_buffer()
+                try:
+                    size = rsp.readinto(memoryview(buffer)[:min(len(buffer), end - position)])
+                except BaseException:
+                    # other segments may be waiting for a free buffer
+                    writer.release_buffer(buffer)
+                    raise
+                if not size:
+                    writer.release_buffer(buffer)
+                    raise IOError(f"Connection closed at {position} of range {segment['start']}-{segment['end']}")
+                writer.write(buffer, size, position, segment)
+                position += size
+                self.update_progress(flag=flag, value=size)
     
     def download_patch_tool(self):
         
@@ -463,20 +3340,77 @@ class Launcher:
             tool_url = "https://gitee.com/tiz/LutheringLaves/raw/main/tools/hpatchz"
             file_name = Path(base_dir) / Path("tools") / "hpatchz"
             
-        if not self.download_file_with_resume(tool_url, file_name): return False
+        try:
+            if not self.download_file_with_resume(tool_url, file_name): return None
+        except UnexpectedStatusError as e:
+            logger.error(f"Failed to download {tool_url}: {e}")
+            return None
         
         if os.name == "posix":
-            os.system(f"chmod +x {str(file_name)}")
+            os.chmod(file_name, file_name.stat().st_mode | 0o111)
+        
+        return file_name
+    
+    def run_hpatchz(self, patch_path, original_path, output_path):
+        tool_path = self.download_patch_tool()
+        if tool_path is None:
+            patch_logger.error("Failed to download hpatchz")
+            return False
+        if output_path.exists():
+            shutil.rmtree(output_path)
+        
+        progress = self.update_game_progress_patch
+        progress.reset(total_size=self.gamefile_index.total_size, total_count=1)
+        cmd = [str(tool_path.resolve()), str(original_path), str(patch_path), str(output_path), '-f']
+        patch_logger.info(f'Applying {patch_path.name}')
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace')
+        
+        output_tail = deque(maxlen=HPATCHZ_OUTPUT_TAIL)
+        def read_output():
+            for line in process.stdout:
+                line = line.rstrip()
+                output_tail.append(line)
+                patch_logger.debug(line)
+                match = HPATCHZ_NEW_SIZE_PATTERN.search(line)
+                if match:
+                    progress.total_size = int(match.group(1))
+        reader = threading.Thread(target=read_output, daemon=True)
+        reader.start()
         
+        # hpatchz has no progress output, the bytes it has written so far are measured instead
+        written_size = 0
+        return_code = None
+        start_time = time.perf_counter()
+        while return_code is None:
+            try:
+                return_code = process.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                pass
+            size = self.get_folder_size(output_path)
+            progress.advance(size=size - written_size)
+            written_size = size
+        reader.join()
+        self.metrics.observe('hpatchz_seconds', time.perf_counter() - start_time)
+        
+        if return_code != 0:
+            self.metrics.inc('hpatchz_failures_total')
+            patch_logger.error(f'hpatchz failed with exit code {return_code} on {patch_path}:')
+            for line in output_tail:
+                patch_logger.error(f'  {line}')
+            return False
+        progress.advance(count=1)
         return True
     
-    def run_hpatchz(self,patch_path, original_path, output_path):
-        self.download_patch_tool()
-        if os.name == "nt":
-            cmd = f'tools\hpatchz.exe "{original_path}" {patch_path} "{output_path}" -f'
-        if os.name == "posix":
-            cmd = f'tools/hpatchz "{original_path}" {patch_path} "{output_path}" -f'
-        os.system(cmd)
+    def get_folder_size(self, folder_path):
+        size = 0
+        for root, _, files in os.walk(folder_path):
+            for name in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    # hpatchz may still be creating or renaming it
+                    pass
+        return size
 
     def is_support_incremental_patching(self):
         if not self.local_version: return False
@@ -508,34 +3442,106 @@ class Launcher:
         self.gamefile_index_patch = self.get_result(urljoin(self.cdn_node, indexfile_uri))
     
     def set_progress_callback(self, callback):
+        # the callback runs on the reporter thread with an immutable ProgressSnapshot
+        if self.progress_reporter:
+            self.progress_reporter.stop()
+            self.progress_reporter = None
         self.progress_callback = callback
+        if callback:
+            progress_map = {
+                "download": self.download_game_progress,
+                "verify": self.verify_game_progress,
+                "update": self.update_game_progress,
+                "update_patch": self.update_game_progress_patch,
+            }
+            self.progress_reporter = ProgressReporter(progress_map, callback, is_paused=self.is_paused)
+            self.progress_reporter.start()
     
-    def update_progress(self, flag, value):
+    def set_bandwidth_limit(self, rate):
+        # bytes per second over all connections, 0 for unlimited; applies to running downloads too
+        self.http_pool.limiter.set_rate(rate)
+        logger.info(f"Bandwidth limit: {format_size(rate) + '/s' if rate else 'unlimited'}")
+    
+    def pause(self):
+        self.resume_event.clear()
+        logger.info('Paused')
+    
+    def resume(self):
+        self.resume_event.set()
+        logger.info('Resumed')
+    
+    def is_paused(self):
+        return not self.resume_event.is_set()
+    
+    def wait_if_paused(self):
+        if not self.resume_event.is_set():
+            self.resume_event.wait()
+    
+    def get_progress(self, flag):
         if flag == "download":
-            self.download_game_progress.finished_size += value
+            return self.download_game_progress
         elif flag == "update":
-            self.update_game_progress.finished_size += value
+            return self.update_game_progress
         elif flag == "verify":
-            self.verify_game_progress.finished_size += value
+            return self.verify_game_progress
         elif flag == "update_patch":
-            self.update_game_progress_patch.finished_size += value
-        
-        mutil_progress = {
-            "download": self.download_game_progress,
-            "verify": self.verify_game_progress,
-            "update": self.update_game_progress,
-            "update_patch": self.update_game_progress_patch,
-        }
-        
-        if self.progress_callback:
-            self.progress_callback(mutil_progress, flag) 
+            return self.update_game_progress_patch
+        return None
+    
+    def update_progress(self, flag, value):
+        # called for every chunk, so only counters are touched here
+        progress = self.get_progress(flag)
+        if progress:
+            progress.advance(size=value)
+        self.wait_if_paused()
 
+    def get_verified_md5(self, file_path, dest):
+        if not self.deep_verify:
+            cached_md5 = self.hash_cache.lookup(dest, file_path)
+            if cached_md5:
+                self.metrics.inc('hash_cache_hits_total')
+                return cached_md5
+        with self.metrics.timer('hash_file_seconds'):
+            md5 = self.get_file_md5(file_path)
+        if md5:
+            self.metrics.inc('hash_bytes_total', os.path.getsize(file_path))
+            self.hash_cache.record(dest, file_path, md5)
+        else:
+            self.hash_cache.forget(dest)
+        return md5
+    
+    def hash_resources(self, resource_list):
+        # hashlib releases the GIL on large buffers, so threads hash files in parallel
+        try:
+            with ThreadPoolExecutor(max_workers=self.hash_jobs) as executor:
+                futures = {
+                    executor.submit(self.get_verified_md5, self.game_folder_path.joinpath(Path(file.dest)), file.dest): file
+                    for file in resource_list
+                }
+                for future in as_completed(futures):
+                    yield futures[future], future.result()
+        finally:
+            self.hash_cache.save()
+    
+    def update_file_md5(self, md5_hash, file_path, size=None):
+        # size limits the hash to a prefix, e.g. the downloaded part of a preallocated file
+        buffer = bytearray(HASH_BUFFER_SIZE)
+        view = memoryview(buffer)
+        remaining = size
+        with open(file_path, "rb", buffering=0) as file:
+            while remaining is None or remaining > 0:
+                read_size = file.readinto(view if remaining is None else view[:min(len(buffer), remaining)])
+                if not read_size:
+                    break
+                md5_hash.update(view[:read_size])
+                if remaining is not None:
+                    remaining -= read_size
+                self.wait_if_paused()
+    
     def get_file_md5(self, file_path):
         md5_hash = hashlib.md5()
         try:
-            with open(file_path, "rb") as file:
-                for chunk in iter(lambda: file.read(4096), b""):
-                    md5_hash.update(chunk)
+            self.update_file_md5(md5_hash, file_path)
             return md5_hash.hexdigest()
         except FileNotFoundError:
             logger.error(f"The file {file_path} does not exist.")
@@ -653,6 +3659,10 @@ class Launcher:
             return proton_versions[0]
         return None
     
+    def save_metrics(self):
+        self.metrics.save(Path(base_dir) / 'launcherMetrics.json',
+                          self.metrics_textfile_path or Path(base_dir) / 'launcherMetrics.prom')
+    
     def update_settings(self):
         settings_file_path = Path(base_dir) / 'settings.json'
         with open(settings_file_path, 'w', encoding='utf-8') as f:
@@ -663,23 +3673,104 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--mode', default='install',help='install or update or patch-update')
     parser.add_argument('--folder', default='Wuthering Waves Game',help='set download folder')
+    parser.add_argument('--jobs', type=int, default=None, help='number of files downloaded at the same time')
+    parser.add_argument('--deep-verify', action='store_true', help='ignore the hash cache and re-hash every file')
+    parser.add_argument('--hash-jobs', type=int, default=None, help='number of files hashed at the same time')
+    parser.add_argument('--segments', type=int, default=None, help='number of concurrent ranges used for each large file')
+    parser.add_argument('--limit-rate', type=parse_rate, default=None, metavar='RATE',
+                        help='total download speed limit in bytes per second, e.g. 500K or 2M, 0 for unlimited')
+    parser.add_argument('--log-level', action='append', default=[], metavar='[PHASE=]LEVEL',
+                        help=f'log level of all output or of one phase ({", ".join(LOG_PHASES)}), may be repeated')
+    parser.add_argument('--serve', nargs='?', const=f':{DEFAULT_MIRROR_PORT}', default=None, metavar='[HOST]:PORT',
+                        help=f'serve the verified game folder to other launchers on the LAN (default port {DEFAULT_MIRROR_PORT})')
+    parser.add_argument('--daemon', nargs='?', const=DEFAULT_DAEMON_ADDRESS, default=None, metavar='[HOST]:PORT|unix:PATH',
+                        help=f'keep the launcher running with a json control api (default {DEFAULT_DAEMON_ADDRESS})')
+    parser.add_argument('--mirror', default=None, metavar='URL',
+                        help='download from a launcher started with --serve first, falling back to the cdn')
+    parser.add_argument('--store', default=None, metavar='PATH',
+                        help='content store shared by installs and versions, files found there are linked instead of downloaded')
+    parser.add_argument('--metrics-textfile', default=None, metavar='PATH',
+                        help='where the prometheus metrics of the run are written, e.g. into the node_exporter textfile directory')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile the run with cProfile and tracemalloc, written to launcherProfile.pstats/.txt')
+    parser.add_argument('--store-max-size', type=parse_size, default=0, metavar='SIZE',
+                        help='evict blobs no install uses once the store is larger than this, e.g. 100G')
     args = parser.parse_args()
     
+    for log_level in args.log_level:
+        phase, _, level = log_level.rpartition('=')
+        set_log_levels({phase or 'all': level})
+    
+    profiler = None
+    if args.profile:
+        profiler = RunProfiler()
+        profiler.start()
+    
     launcher = Launcher(game_folder=args.folder)
-    launcher.verify_gamefile()
-    # download game client file
-    if args.mode == 'install':
-        launcher.download_game()
-        launcher.verify_gamefile()
-        launcher.update_localVersion()  
-    
-    # update game client file
-    if args.mode == 'update':
-        launcher.update_game()
-        launcher.verify_gamefile()
-        launcher.update_localVersion()  
-    
-    # Incremental updates
-    if args.mode == 'patch-update':
-        launcher.download_patch()
-        launcher.merge_patch()
\ No newline at end of file
+    if args.metrics_textfile:
+        launcher.metrics_textfile_path = Path(args.metrics_textfile)
+    if args.jobs:
+        launcher.download_jobs = max(1, args.jobs)
+    if args.segments:
+        launcher.download_segments = max(1, args.segments)
+    if args.hash_jobs:
+        launcher.hash_jobs = max(1, args.hash_jobs)
+    launcher.deep_verify = args.deep_verify
+    if args.limit_rate is not None:
+        launcher.set_bandwidth_limit(args.limit_rate)
+    if args.mirror is not None:
+        launcher.set_mirror(args.mirror)
+    if args.store is not None:
+        launcher.set_content_store(args.store, args.store_max_size)
+    elif args.store_max_size and launcher.content_store:
+        launcher.content_store.max_size = args.store_max_size
+    
+    if args.serve:
+        sys.exit(0 if launcher.serve_mirror(args.serve) else 1)
+    if args.daemon:
+        sys.exit(0 if launcher.serve_daemon(args.daemon) else 1)
+    
+    if sys.stderr.isatty():
+        def print_progress(snapshot):
+            if snapshot.total_size <= 0:
+                return
+            percent = snapshot.finished_size / snapshot.total_size * 100
+            sys.stderr.write(f'\r{snapshot.flag}: {format_size(snapshot.finished_size)} / {format_size(snapshot.total_size)}'
+                             f' {percent:.1f}% {format_size(snapshot.speed)}/s ETA {format_eta(snapshot.eta)}\033[K')
+            sys.stderr.flush()
+        launcher.set_progress_callback(print_progress)
+    
+    failed_files = []
+    
+    try:
+        # download game client file
+        if args.mode == 'install':
+            launcher.download_game()
+            failed_files = launcher.verify_gamefile()
+        
+        # update game client file
+        if args.mode == 'update':
+            failed_files = launcher.update_game()
+        
+        # Incremental updates
+        if args.mode == 'patch-update':
+            if not launcher.support_incremental_patching:
+                logger.error(f'No incremental patch from {launcher.local_version} to {launcher.current_version}')
+                sys.exit(1)
+            failed_files = launcher.download_patch()
+            if not failed_files:
+                failed_files = launcher.merge_patch()
+    except InsufficientDiskSpaceError as e:
+        logger.error(str(e))
+        sys.exit(1)
+    finally:
+        launcher.save_metrics()
+        if profiler:
+            profiler.stop(Path(base_dir) / 'launcherProfile.pstats', Path(base_dir) / 'launcherProfile.txt')
+    
+    if launcher.progress_reporter:
+        launcher.set_progress_callback(None)
+        sys.stderr.write('\n')
+    
+    if failed_files:
+        sys.exit(1)
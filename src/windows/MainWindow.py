@@ -1,10 +1,9 @@
 import os
 import sys
-import threading
 from PySide6.QtWidgets import QMainWindow, QWidget, QVBoxLayout, QLabel, QPushButton
 from PySide6.QtGui import QPixmap, QPalette, QPainter, QFontDatabase, QFont, QIcon
-from PySide6.QtCore import Qt, QThread, Signal
-from ..LutheringLaves import Launcher, LauncherState, ProgressInfo, logger
+from PySide6.QtCore import Qt, QThread, Signal, QTimer
+from ..LutheringLaves import Launcher, LauncherState, ProgressSnapshot, format_size, format_eta, logger
 from ..windows.SettingWindow import SettingsWindow
 
 class DownloadWorker(QThread):
@@ -18,41 +17,35 @@ class DownloadWorker(QThread):
     # update_finished = Signal()
     
     error = Signal(str)
+    # dests of files still missing or corrupt after the retries
+    files_failed = Signal(list)
     
     def __init__(self, launcher:Launcher):
         super().__init__()
         self.launcher = launcher
+        # snapshots arrive from the launcher's reporter thread at a fixed rate
         self.launcher.set_progress_callback(self.update_ui_progress)
 
-        self._paused = False
-        self._resume_event = threading.Event()
-        self._resume_event.set()
-
         logger.info("DownloadWorker initialized.")
     
     def pause(self):
-        self._paused = True
-        self._resume_event.clear()
+        self.launcher.pause()
         logger.info("DownloadWorker paused.")
     
     def resume(self):
-        self._paused = False
-        self._resume_event.set()
+        self.launcher.resume()
         logger.info("DownloadWorker resumed.")
     
     def is_paused(self):
-        return self._paused
+        return self.launcher.is_paused()
     
-    def update_ui_progress(self, mutil_progress, flag):
-        if self._paused:
-            self._resume_event.wait()
-            
-        if flag == "download":
-            self.download_progress.emit(mutil_progress[flag])
-        elif flag == "verify":
-            self.verify_progress.emit(mutil_progress[flag])
-        elif flag == "update":
-            self.update_progress.emit(mutil_progress[flag])
+    def update_ui_progress(self, snapshot: ProgressSnapshot):
+        if snapshot.flag == "download":
+            self.download_progress.emit(snapshot)
+        elif snapshot.flag == "verify":
+            self.verify_progress.emit(snapshot)
+        elif snapshot.flag == "update":
+            self.update_progress.emit(snapshot)
     
     def run(self):
         try:
@@ -60,17 +53,28 @@ class DownloadWorker(QThread):
 
             if self.launcher.state == LauncherState.NEEDINSTALL:
                 logger.info("Starting game download...")
-                self.launcher.download_game()
-                logger.info("Verifying game files...")
-                self.launcher.verify_gamefile()
+                failed_files = self.launcher.download_game()
+                if not failed_files:
+                    logger.info("Verifying game files...")
+                    failed_files = self.launcher.verify_gamefile()
+                # publish the last snapshot before the finished signal
+                self.launcher.set_progress_callback(None)
+                if failed_files:
+                    # the game stays uninstalled, the button starts another attempt
+                    self.launcher.state = LauncherState.NEEDINSTALL
+                    self.files_failed.emit(list(failed_files))
+                    return
                 self.launcher.state = LauncherState.STARTGAME
                 logger.info("Download and verify finished.")
                 self.download_finished.emit()
             if self.launcher.state == LauncherState.NEEDUPDATE:
                 logger.info("Starting game update...")
-                self.launcher.update_game()
-                logger.info("Verifying game files after update...")
-                self.launcher.verify_gamefile()
+                failed_files = self.launcher.update_game()
+                self.launcher.set_progress_callback(None)
+                if failed_files:
+                    self.launcher.state = LauncherState.NEEDUPDATE
+                    self.files_failed.emit(list(failed_files))
+                    return
                 self.launcher.state = LauncherState.STARTGAME
                 logger.info("Update and verify finished.")
                 self.download_finished.emit()
@@ -78,6 +82,8 @@ class DownloadWorker(QThread):
         except Exception as e:
             logger.error(f"Error in DownloadWorker: {e}", exc_info=True)
             self.error.emit(str(e))
+        finally:
+            self.launcher.save_metrics()
 
 class MainWindow(QMainWindow):
     
@@ -177,6 +183,12 @@ class MainWindow(QMainWindow):
     
         self.set_background_images()
         
+        # 背景图片在后台下载，下载完成后刷新背景
+        if not self.launcher.background_ready.is_set():
+            self.background_timer = QTimer(self)
+            self.background_timer.timeout.connect(self.check_background_ready)
+            self.background_timer.start(200)
+        
         self.init_launcher_state()
         logger.info(f"Launcher state: {self.launcher.state}")
     
@@ -257,6 +269,11 @@ class MainWindow(QMainWindow):
             self.setPalette(palette)
             self.setAutoFillBackground(True)
             
+    def check_background_ready(self):
+        if self.launcher.background_ready.is_set():
+            self.background_timer.stop()
+            self.set_background_images()
+            
     def resizeEvent(self, event):
         # 窗口大小改变时重新设置背景
         super().resizeEvent(event)
@@ -295,6 +312,8 @@ class MainWindow(QMainWindow):
             self.worker.download_progress.connect(self.download_progress_ui)
             self.worker.verify_progress.connect(self.verify_progress_ui)
             self.worker.download_finished.connect(self.download_finished_ui)
+            self.worker.files_failed.connect(self.files_failed_ui)
+            self.worker.error.connect(self.download_error)
             self.worker.start()
             return
             
@@ -304,6 +323,8 @@ class MainWindow(QMainWindow):
             self.worker.update_progress.connect(self.update_progress_ui)
             self.worker.verify_progress.connect(self.verify_progress_ui)
             self.worker.download_finished.connect(self.download_finished_ui)
+            self.worker.files_failed.connect(self.files_failed_ui)
+            self.worker.error.connect(self.download_error)
             self.worker.start()
             return
         
@@ -326,7 +347,7 @@ class MainWindow(QMainWindow):
             self.action_button.setText("继续")
             return
 
-    def download_progress_ui(self, info: ProgressInfo):
+    def download_progress_ui(self, info: ProgressSnapshot):
         if self.worker.is_paused():
             self.action_button.setText("继续")
             return
@@ -334,18 +355,20 @@ class MainWindow(QMainWindow):
         self.info_label.setVisible(True)
         finished_size = info.finished_size
         total_size = info.total_size
-        self.info_label.setText(f"已下载 {finished_size / 1024 / 1024 / 1024:.1f}GB / {total_size / 1024 / 1024 /1024:.1f}GB")
+        self.info_label.setText(f"已下载 {finished_size / 1024 / 1024 / 1024:.1f}GB / {total_size / 1024 / 1024 /1024:.1f}GB"
+                                f"  {format_size(info.speed)}/s  剩余 {format_eta(info.eta)}")
     
-    def verify_progress_ui(self, info: ProgressInfo):
+    def verify_progress_ui(self, info: ProgressSnapshot):
         if self.worker.is_paused():
             self.action_button.setText("继续")
             return
         self.info_label.setVisible(True)
         finished_size = info.finished_size
         total_size = info.total_size
-        self.info_label.setText(f"已校验 {finished_size / 1024 / 1024 / 1024:.1f}GB / {total_size / 1024 / 1024 /1024:.1f}GB")
+        self.info_label.setText(f"已校验 {finished_size / 1024 / 1024 / 1024:.1f}GB / {total_size / 1024 / 1024 /1024:.1f}GB"
+                                f"  {format_size(info.speed)}/s  剩余 {format_eta(info.eta)}")
         
-    def update_progress_ui(self, info: ProgressInfo):
+    def update_progress_ui(self, info: ProgressSnapshot):
         if self.worker.is_paused():
             self.action_button.setText("继续")
             return
@@ -353,7 +376,8 @@ class MainWindow(QMainWindow):
         self.info_label.setVisible(True)
         finished_size = info.finished_size
         total_size = info.total_size
-        self.info_label.setText(f"已更新 {finished_size / 1024 / 1024 / 1024:.1f}GB / {total_size / 1024 / 1024 /1024:.1f}GB")
+        self.info_label.setText(f"已更新 {finished_size / 1024 / 1024 / 1024:.1f}GB / {total_size / 1024 / 1024 /1024:.1f}GB"
+                                f"  {format_size(info.speed)}/s  剩余 {format_eta(info.eta)}")
     
     def download_finished_ui(self):
         logger.info("Download finished. Ready to launch game.")
@@ -365,6 +389,18 @@ class MainWindow(QMainWindow):
         logger.error(f"Download error: {error}")
         self.action_button.setEnabled(True)
         self.action_button.setText("下载失败")
+        # 例如磁盘空间不足，开始下载前就会报错
+        self.info_label.setVisible(True)
+        self.info_label.setText(str(error))
+        self.info_label.setToolTip(str(error))
+    
+    def files_failed_ui(self, failed_files):
+        logger.error(f"{len(failed_files)} files failed: {failed_files}")
+        # 状态仍是NEEDINSTALL/NEEDUPDATE，再次点击按钮会重试
+        self.init_launcher_state()
+        self.info_label.setVisible(True)
+        self.info_label.setText(f"{len(failed_files)} 个文件下载失败，点击重试")
+        self.info_label.setToolTip("\n".join(failed_files))
     
     def monitor_game_process(self):
         if hasattr(self, 'game_process') and self.launcher:
@@ -1,6 +1,19 @@
-from PySide6.QtWidgets import QVBoxLayout, QDialog, QComboBox, QWidget, QCheckBox, QGroupBox, QFormLayout, QPushButton, QHBoxLayout
-from PySide6.QtCore import Qt
-from src.LutheringLaves import Launcher, logger
+from PySide6.QtWidgets import QVBoxLayout, QDialog, QComboBox, QWidget, QCheckBox, QGroupBox, QFormLayout, QPushButton, QHBoxLayout, QLineEdit
+from PySide6.QtCore import Qt, QThread, Signal
+from src.LutheringLaves import Launcher, logger, parse_rate
+
+class MirrorWorker(QThread):
+    # 输入的地址，以及可用时规范化后的地址，不可用时为None
+    mirror_checked = Signal(str, object)
+    
+    def __init__(self, launcher: Launcher, mirror_url, parent=None):
+        super().__init__(parent)
+        self.launcher = launcher
+        self.mirror_url = mirror_url
+    
+    def run(self):
+        # 探测镜像可能要等到超时，不能放在界面线程
+        self.mirror_checked.emit(self.mirror_url, self.launcher.probe_mirror(self.mirror_url))
 
 class SettingsWindow(QDialog):
     def __init__(self, parent=None, launcher: Launcher = None):
@@ -28,6 +41,9 @@ class SettingsWindow(QDialog):
         # 添加复选框分组
         self.add_checkbox_group(layout)
         
+        # 添加下载设置分组
+        self.add_download_group(layout)
+        
         # 添加按钮
         #self.add_button(layout)
         
@@ -120,6 +136,47 @@ class SettingsWindow(QDialog):
         
         layout.addWidget(checkbox_group)
     
+    def add_download_group(self, layout):
+        # 创建下载设置分组
+        download_group = QGroupBox("下载设置")
+        download_layout = QFormLayout()
+        download_group.setLayout(download_layout)
+        
+        current_jobs = str(self.launcher.settings.get('download_jobs', self.launcher.download_jobs))
+        
+        self.jobs_combo_box = QComboBox()
+        for jobs in ["1", "2", "4", "8", "16"]:
+            self.jobs_combo_box.addItem(jobs)
+        if self.jobs_combo_box.findText(current_jobs) == -1:
+            self.jobs_combo_box.addItem(current_jobs)
+        self.jobs_combo_box.setCurrentText(current_jobs)
+        
+        self.jobs_combo_box.currentTextChanged.connect(self.on_jobs_changed)
+        
+        download_layout.addRow("同时下载文件数：", self.jobs_combo_box)
+        
+        current_limit = str(self.launcher.settings.get('bandwidth_limit', '0'))
+        
+        self.limit_combo_box = QComboBox()
+        self.limit_combo_box.addItem("不限速", "0")
+        for limit in ["1M", "2M", "5M", "10M", "20M", "50M"]:
+            self.limit_combo_box.addItem(f"{limit}B/s", limit)
+        if self.limit_combo_box.findData(current_limit) == -1:
+            self.limit_combo_box.addItem(f"{current_limit}B/s", current_limit)
+        self.limit_combo_box.setCurrentIndex(self.limit_combo_box.findData(current_limit))
+        
+        self.limit_combo_box.currentIndexChanged.connect(self.on_limit_changed)
+        
+        download_layout.addRow("下载限速：", self.limit_combo_box)
+        
+        self.mirror_line_edit = QLineEdit(self.launcher.settings.get('mirror_url', ''))
+        self.mirror_line_edit.setPlaceholderText("http://192.168.1.10:8080/")
+        self.mirror_line_edit.editingFinished.connect(self.on_mirror_changed)
+        
+        download_layout.addRow("局域网镜像：", self.mirror_line_edit)
+        
+        layout.addWidget(download_group)
+    
     def add_bottom_buttons(self, layout):
         # 创建底部按钮布局
         button_layout = QHBoxLayout()
@@ -166,6 +223,44 @@ class SettingsWindow(QDialog):
             self.launcher.settings['proton_version'] = text
             self.launcher.update_settings()
 
+    def on_jobs_changed(self, text):
+        # 并发下载数变化时的处理函数
+        self.launcher.settings['download_jobs'] = text
+        self.launcher.download_jobs = int(text)
+        self.launcher.update_settings()
+
+    def on_limit_changed(self, index):
+        # 限速变化时立即作用于正在进行的下载
+        limit = self.limit_combo_box.itemData(index)
+        self.launcher.settings['bandwidth_limit'] = limit
+        self.launcher.set_bandwidth_limit(parse_rate(limit))
+        self.launcher.update_settings()
+
+    def on_mirror_changed(self):
+        # 镜像地址留空则直接从CDN下载
+        mirror_url = self.mirror_line_edit.text().strip()
+        if mirror_url == self.launcher.settings.get('mirror_url', ''):
+            return
+        self.launcher.settings['mirror_url'] = mirror_url
+        self.launcher.update_settings()
+        # 探测完成前先从CDN下载
+        self.launcher.mirror_url = None
+        self.mirror_line_edit.setToolTip("")
+        if not mirror_url:
+            return
+        self.mirror_line_edit.setToolTip("正在检查镜像...")
+        worker = MirrorWorker(self.launcher, mirror_url, parent=self)
+        worker.mirror_checked.connect(self.on_mirror_checked)
+        worker.finished.connect(worker.deleteLater)
+        worker.start()
+
+    def on_mirror_checked(self, mirror_url, usable_url):
+        # 检查期间地址又被修改过时，结果作废
+        if mirror_url != self.launcher.settings.get('mirror_url', ''):
+            return
+        self.launcher.mirror_url = usable_url
+        self.mirror_line_edit.setToolTip("镜像可用" if usable_url else "镜像不可用，直接从CDN下载")
+
     def on_checkbox_changed(self, checkbox_name, state):
         # 复选框状态变化时的处理函数
         checkbox = getattr(self, checkbox_name, None)
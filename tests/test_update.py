@@ -0,0 +1,215 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+import unittest
+import zipfile
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR / 'benchmark'))
+
+from benchmark import Dataset, FakeCdnServer, GAME_FOLDER, OLD_VERSION, NEW_VERSION, save_json
+
+# stands in for hpatchz: a diff is a zip of the new files, its comment lists the old files it reads and their md5
+STUB_HPATCHZ = '''#!{python}
+import os, sys, json, hashlib, zipfile
+if sys.argv[1] == '-info':
+    with zipfile.ZipFile(sys.argv[2]) as diff:
+        print('newSumSize: %d' % sum(info.file_size for info in diff.infolist()))
+    sys.exit(0)
+old_path, diff_path, out_path = sys.argv[1:4]
+with zipfile.ZipFile(diff_path) as diff:
+    for dest, md5 in json.loads(diff.comment).items():
+        with open(os.path.join(old_path, dest), 'rb') as file:
+            if hashlib.md5(file.read()).hexdigest() != md5:
+                print('oldPath checksum error: ' + dest)
+                sys.exit(1)
+    with open(os.environ['HPATCHZ_STUB_LOG'], 'a') as log:
+        log.write(json.dumps({{'diff': os.path.basename(diff_path),
+                              'staged': sorted(os.listdir(os.path.dirname(out_path)))}}) + '\\n')
+    diff.extractall(out_path)
+print('patch ok!')
+'''
+
+# runs in a fresh process, the launcher is a singleton and keeps its state next to sys.argv[0]
+WORKER = '''
+import os, sys, json
+work_path, api, scenario, result_path = sys.argv[1:5]
+os.chdir(work_path)
+sys.argv = [os.path.join(work_path, 'LutheringLaves.py')]
+sys.path.insert(0, {repo!r})
+import src.LutheringLaves as LutheringLaves
+LutheringLaves.WW_LAUNCHER_API = api + 'index.json'
+LutheringLaves.WW_LAUNCHER_DOWNLOAD_API = api + 'background.json'
+launcher = LutheringLaves.Launcher(game_folder={game_folder!r})
+plans = []
+check_disk_space = launcher.check_disk_space
+def record_plan(plan):
+    plans.append(vars(plan))
+    check_disk_space(plan)
+launcher.check_disk_space = record_plan
+if scenario == 'install':
+    failed_files = launcher.download_game() or launcher.verify_gamefile()
+elif scenario == 'update':
+    failed_files = launcher.update_game()
+elif scenario == 'patch-update':
+    failed_files = launcher.download_patch()
+    if failed_files is not None and not failed_files:
+        failed_files = launcher.merge_patch()
+with open(result_path, 'w', encoding='utf-8') as file:
+    json.dump({{'failed_files': failed_files, 'plans': plans, 'local_version': launcher.local_version}}, file)
+'''.format(repo=str(REPO_DIR), game_folder=GAME_FOLDER)
+
+def file_md5(file_path):
+    with open(file_path, 'rb') as file:
+        return hashlib.md5(file.read()).hexdigest()
+
+class UpdateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root_path = Path(tempfile.mkdtemp(prefix='lutheringlaves-test-'))
+        self.addCleanup(shutil.rmtree, self.root_path, ignore_errors=True)
+        self.dataset = Dataset(self.root_path / 'cdn', 12, [(64 * 1024, 1)], 0.5, seed=7)
+        self.dataset.build()
+        self.server = FakeCdnServer(self.root_path / 'cdn')
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.work_path = self.root_path / 'work'
+        self.work_path.mkdir()
+        self.run_launcher('install')
+        self.server.version = NEW_VERSION
+
+    def run_launcher(self, scenario, env=None):
+        result_path = self.root_path / f'{scenario}.result.json'
+        process = subprocess.run([sys.executable, '-c', WORKER, str(self.work_path), self.server.url, scenario, str(result_path)],
+                                 env=dict(os.environ, **(env or {})), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        self.assertEqual(process.returncode, 0, process.stdout)
+        with open(result_path, 'r', encoding='utf-8') as file:
+            result = json.load(file)
+        self.assertEqual(result['failed_files'], [], process.stdout)
+        return result
+
+    def assert_new_version_installed(self, result):
+        self.assertEqual(result['local_version'], NEW_VERSION)
+        game_path = self.work_path / GAME_FOLDER
+        for entry in self.dataset.manifests[NEW_VERSION]:
+            self.assertEqual(file_md5(game_path / entry['dest']), entry['md5'], entry['dest'])
+        new_dests = {entry['dest'] for entry in self.dataset.manifests[NEW_VERSION]}
+        for entry in self.dataset.manifests[OLD_VERSION]:
+            if entry['dest'] not in new_dests:
+                self.assertFalse((game_path / entry['dest']).exists(), entry['dest'])
+
+class UpdateByDiffTest(UpdateTestCase):
+
+    def test_update_rewrites_changed_files_only(self):
+        result = self.run_launcher('update')
+        self.assert_new_version_installed(result)
+        old_md5 = {entry['dest']: entry['md5'] for entry in self.dataset.manifests[OLD_VERSION]}
+        changed_size = sum(entry['size'] for entry in self.dataset.manifests[NEW_VERSION]
+                           if old_md5.get(entry['dest']) != entry['md5'])
+        self.assertEqual(len(result['plans']), 1)
+        self.assertEqual(result['plans'][0]['download_size'], changed_size)
+
+    def test_update_restores_missing_unchanged_file(self):
+        # an unchanged file that went missing is downloaded along with the changed ones
+        old_md5 = {entry['dest']: entry['md5'] for entry in self.dataset.manifests[OLD_VERSION]}
+        missing = next(entry for entry in self.dataset.manifests[NEW_VERSION] if old_md5.get(entry['dest']) == entry['md5'])
+        (self.work_path / GAME_FOLDER / missing['dest']).unlink()
+        result = self.run_launcher('update')
+        self.assert_new_version_installed(result)
+        changed_size = sum(entry['size'] for entry in self.dataset.manifests[NEW_VERSION]
+                           if old_md5.get(entry['dest']) != entry['md5'])
+        self.assertEqual(result['plans'][0]['download_size'], changed_size + missing['size'])
+
+@unittest.skipIf(os.name == 'nt', 'the stub hpatchz is a python script run through its shebang')
+class PatchUpdateTest(UpdateTestCase):
+
+    DIFF_COUNT = 3
+
+    def setUp(self):
+        super().setUp()
+        tool_path = self.work_path / 'tools' / 'hpatchz'
+        tool_path.parent.mkdir()
+        tool_path.write_text(STUB_HPATCHZ.format(python=sys.executable))
+        tool_path.chmod(0o755)
+        self.stub_log_path = self.root_path / 'hpatchz.log'
+        self.build_patch()
+
+    def build_patch(self):
+        # every diff rewrites its own share of the changed files, the way a multi-part patch does
+        patch_name = f'{OLD_VERSION}-{NEW_VERSION}'
+        patch_path = self.dataset.cdn_path / 'patch' / patch_name
+        patch_path.mkdir(parents=True)
+        old_md5 = {entry['dest']: entry['md5'] for entry in self.dataset.manifests[OLD_VERSION]}
+        resources = []
+        self.output_sizes = []
+        for i in range(self.DIFF_COUNT):
+            dests = self.dataset.changed_dests[i::self.DIFF_COUNT]
+            diff_path = patch_path / f'game{i}.krdiff'
+            with zipfile.ZipFile(diff_path, 'w') as diff:
+                for dest in dests:
+                    diff.write(self.dataset.resource_path(NEW_VERSION, dest), dest)
+                diff.comment = json.dumps({dest: old_md5[dest] for dest in dests}).encode('utf-8')
+            self.output_sizes.append(sum(self.dataset.resource_path(NEW_VERSION, dest).stat().st_size for dest in dests))
+            resources.append({'dest': diff_path.name, 'md5': file_md5(diff_path), 'size': diff_path.stat().st_size})
+        resources += [dict(entry, fromFolder=f'res/{NEW_VERSION}')
+                      for entry in self.dataset.manifests[NEW_VERSION] if entry['dest'] not in old_md5]
+        save_json(patch_path / 'index.json', {'resource': resources})
+        self.server.patch_config = [{
+            'version': OLD_VERSION,
+            'baseUrl': f'patch/{patch_name}',
+            'indexFile': f'patch/{patch_name}/index.json',
+            'ext': {'krdiff': 'game0.krdiff'},
+        }]
+
+    def test_diffs_are_applied_one_at_a_time(self):
+        self.assertGreaterEqual(len(self.dataset.changed_dests), self.DIFF_COUNT)
+        result = self.run_launcher('patch-update', env={'HPATCHZ_STUB_LOG': str(self.stub_log_path)})
+        self.assert_new_version_installed(result)
+
+        # a diff reads the installed files, and the output of the diff before it is already moved away
+        with open(self.stub_log_path, 'r', encoding='utf-8') as file:
+            runs = [json.loads(line) for line in file]
+        self.assertEqual([run['diff'] for run in runs], [f'game{i}.krdiff' for i in range(self.DIFF_COUNT)])
+        for run in runs:
+            self.assertNotIn('patch', run['staged'])
+        self.assertFalse((self.work_path / 'temp_folder').exists())
+        self.assertFalse((self.work_path / 'patch_folder').exists())
+
+        # merge_patch stages the largest single output, not one output per diff
+        merge_plan = result['plans'][-1]
+        self.assertEqual(merge_plan['staging_size'], max(self.output_sizes))
+        download_plan = result['plans'][0]
+        self.assertLess(download_plan['staging_size'], download_plan['download_size'] + self.DIFF_COUNT * self.dataset.size(NEW_VERSION))
+
+    def test_retry_skips_applied_diffs(self):
+        # the second diff finds a damaged input, the diffs after it must not run
+        dest = self.dataset.changed_dests[1]
+        game_file_path = self.work_path / GAME_FOLDER / dest
+        with open(game_file_path, 'r+b') as file:
+            file.write(b'\0' * 16)
+        env = dict(os.environ, HPATCHZ_STUB_LOG=str(self.stub_log_path))
+        result_path = self.root_path / 'patch-update.result.json'
+        subprocess.run([sys.executable, '-c', WORKER, str(self.work_path), self.server.url, 'patch-update', str(result_path)],
+                       env=env, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+        with open(result_path, 'r', encoding='utf-8') as file:
+            result = json.load(file)
+        self.assertEqual(result['failed_files'], ['game1.krdiff'])
+        self.assertEqual(result['local_version'], OLD_VERSION)
+
+        # once the input is repaired, the retry goes on from the diff that failed
+        shutil.copy(self.dataset.resource_path(OLD_VERSION, dest), game_file_path)
+        result = self.run_launcher('patch-update', env=env)
+        self.assert_new_version_installed(result)
+        with open(self.stub_log_path, 'r', encoding='utf-8') as file:
+            runs = [json.loads(line)['diff'] for line in file]
+        self.assertEqual(runs, [f'game{i}.krdiff' for i in range(self.DIFF_COUNT)])
+
+if __name__ == '__main__':
+    unittest.main()